@@ -3,6 +3,29 @@ import { LipSyncAnalyzeResult } from "./lipSyncAnalyzeResult";
 
 const TIME_DOMAIN_DATA_LENGTH = 2048;
 
+/**
+ * 服务端预先计算的口型包络：每帧的音量（0~255）和口型编号
+ */
+export type LipEnvelope = {
+  fps: number;
+  volume: number[];
+  viseme: number[];
+};
+
+const VISEMES: VRMExpressionPresetName[] = ["aa", "ou", "oh", "ee"];
+
+type EnvelopeSegment = LipEnvelope & { start: number };
+
+type StreamClip = {
+  pending: number;
+  closed: boolean;
+  started: boolean;
+  lipStart?: number;
+  lipFrames: number;
+  onStart?: () => void;
+  onEnded?: () => void;
+};
+
 export class LipSync {
   public readonly audio: AudioContext;
   public readonly analyser: AnalyserNode;
@@ -18,6 +41,12 @@ export class LipSync {
   }
 
   public update(): LipSyncAnalyzeResult {
+    // 有服务端包络时直接插值，不再逐帧分析音频
+    const fromEnvelope = this.sampleEnvelope();
+    if (fromEnvelope) {
+      return fromEnvelope;
+    }
+
     this.analyser.getFloatTimeDomainData(this.timeDomainData);
 
     let volume = 0.0;
@@ -41,6 +70,37 @@ export class LipSync {
     };
   }
 
+  private _envelopes: EnvelopeSegment[] = [];
+
+  private addEnvelope(lip: LipEnvelope, start: number) {
+    if (lip.volume.length > 0) {
+      this._envelopes.push({ ...lip, start });
+    }
+  }
+
+  private sampleEnvelope(): LipSyncAnalyzeResult | undefined {
+    const now = this.audio.currentTime;
+    // 丢弃已经播完的段
+    while (
+      this._envelopes.length > 0 &&
+      this._envelopes[0].start + this._envelopes[0].volume.length / this._envelopes[0].fps <= now
+    ) {
+      this._envelopes.shift();
+    }
+    const segment = this._envelopes[0];
+    if (!segment || now < segment.start) return undefined;
+
+    const position = (now - segment.start) * segment.fps;
+    const index = Math.floor(position);
+    const current = segment.volume[index];
+    const next = segment.volume[index + 1] ?? current;
+    const volume = (current + (next - current) * (position - index)) / 255;
+    return {
+      volume,
+      phoneme: VISEMES[segment.viseme[index]] ?? "ou",
+    };
+  }
+
   private analyzePhoneme(frequencyData: Float32Array): VRMExpressionPresetName {
     // 1. 准备划分的频带区间（单位：Hz），以及频率 bin 与 Hz 的转换
     //    通常 sampleRate = 44100 或 48000，根据具体音频上下文而定
@@ -112,7 +172,11 @@ export class LipSync {
     return count > 0 ? sum / count : -Infinity;
   }
 
-  public async playFromArrayBuffer(buffer: ArrayBuffer, onEnded?: () => void) {
+  public async playFromArrayBuffer(
+    buffer: ArrayBuffer,
+    onEnded?: () => void,
+    lip?: LipEnvelope
+  ) {
     const audioBuffer = await this.audio.decodeAudioData(buffer);
 
     const bufferSource = this.audio.createBufferSource();
@@ -121,11 +185,128 @@ export class LipSync {
     bufferSource.connect(this.audio.destination);
     bufferSource.connect(this.analyser);
     bufferSource.start();
+    if (lip) {
+      this.addEnvelope(lip, this.audio.currentTime);
+    }
     if (onEnded) {
       bufferSource.addEventListener("ended", onEnded);
     }
   }
 
+  private _streamSampleRate = 44100;
+  private _streamFormat = "pcm";
+  private _streamNextTime = 0;
+  private _streamClip?: StreamClip;
+  private _streamDecoding: Promise<void> = Promise.resolve();
+
+  /**
+   * 开始一段流式音频，之后通过 appendStream 追加分片
+   * format 为 pcm 时分片是 16bit PCM，否则每个分片是一个完整的压缩音频文件（如 Ogg Opus）
+   * 上一段尚未播完时，新的一段会无缝排在它后面，onStart 在实际开始播放时回调
+   */
+  public startStream(sampleRate: number, onStart?: () => void, format: string = "pcm") {
+    this._streamSampleRate = sampleRate;
+    this._streamFormat = format;
+    this._streamClip = {
+      pending: 0,
+      closed: false,
+      started: false,
+      lipFrames: 0,
+      onStart,
+    };
+  }
+
+  /**
+   * 追加一个分片，按顺序无缝排在上一个分片之后播放
+   * 压缩分片需要异步解码，所有分片串行解码，保证跨段也按到达顺序排队
+   */
+  public appendStream(data: ArrayBuffer, lip?: LipEnvelope) {
+    const clip = this._streamClip;
+    if (!clip || data.byteLength === 0) return;
+
+    if (this._streamFormat === "pcm") {
+      const samples = new Int16Array(data);
+      const audioBuffer = this.audio.createBuffer(
+        1,
+        samples.length,
+        this._streamSampleRate
+      );
+      const channel = audioBuffer.getChannelData(0);
+      for (let i = 0; i < samples.length; i++) {
+        channel[i] = samples[i] / 32768;
+      }
+      this.scheduleStream(clip, audioBuffer, lip);
+      return;
+    }
+
+    // 解码期间计入 pending，避免 endStream 在最后一个分片解码完之前就回调
+    clip.pending += 1;
+    this._streamDecoding = this._streamDecoding
+      .then(() => this.audio.decodeAudioData(data))
+      .then((audioBuffer) => this.scheduleStream(clip, audioBuffer, lip))
+      .catch((e) => console.error("音频分片解码失败:", e))
+      .finally(() => {
+        clip.pending -= 1;
+        this.finishClipIfDone(clip);
+      });
+  }
+
+  /**
+   * 把一个分片排到上一个分片之后播放
+   * 分片的口型帧与整段连续编号，按段起点加已有帧数排到时间轴上
+   */
+  private scheduleStream(clip: StreamClip, audioBuffer: AudioBuffer, lip?: LipEnvelope) {
+    const bufferSource = this.audio.createBufferSource();
+    bufferSource.buffer = audioBuffer;
+    bufferSource.connect(this.audio.destination);
+    bufferSource.connect(this.analyser);
+
+    const startAt = Math.max(this.audio.currentTime, this._streamNextTime);
+    bufferSource.start(startAt);
+    this._streamNextTime = startAt + audioBuffer.duration;
+    if (clip.lipStart === undefined) {
+      clip.lipStart = startAt;
+    }
+    if (lip) {
+      this.addEnvelope(lip, clip.lipStart + clip.lipFrames / lip.fps);
+      clip.lipFrames += lip.volume.length;
+    }
+    if (!clip.started) {
+      clip.started = true;
+      const onStart = clip.onStart;
+      if (onStart) {
+        setTimeout(onStart, (startAt - this.audio.currentTime) * 1000);
+      }
+    }
+    clip.pending += 1;
+    bufferSource.addEventListener("ended", () => {
+      clip.pending -= 1;
+      this.finishClipIfDone(clip);
+    });
+  }
+
+  /**
+   * 标记当前这段流式音频结束，所有分片播放完后回调 onEnded
+   */
+  public endStream(onEnded?: () => void) {
+    const clip = this._streamClip;
+    if (!clip) {
+      onEnded?.();
+      return;
+    }
+    clip.closed = true;
+    clip.onEnded = onEnded;
+    this.finishClipIfDone(clip);
+  }
+
+  private finishClipIfDone(clip: StreamClip) {
+    if (clip.closed && clip.pending === 0 && clip.onEnded) {
+      const onEnded = clip.onEnded;
+      clip.onEnded = undefined;
+      onEnded();
+    }
+  }
+
   public async playFromURL(url: string, onEnded?: () => void) {
     const res = await fetch(url);
     const buffer = await res.arrayBuffer();
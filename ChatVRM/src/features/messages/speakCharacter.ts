@@ -3,6 +3,7 @@ import { synthesizeVoiceApi } from "./synthesizeVoice";
 import { Viewer } from "../vrmViewer/viewer";
 import { Screenplay } from "./messages";
 import { Talk } from "./messages";
+import { LipEnvelope } from "../lipSync/lipSync";
 
 const createSpeakCharacter = () => {
   let lastTime = 0;
@@ -15,7 +16,8 @@ const createSpeakCharacter = () => {
     viewer: Viewer,
     koeiroApiKey: string,
     onStart?: () => void,
-    onComplete?: () => void
+    onComplete?: () => void,
+    lip?: LipEnvelope
   ) => {
     const fetchPromise = prevFetchPromise.then(async () => {
       const now = Date.now();
@@ -38,7 +40,7 @@ const createSpeakCharacter = () => {
         if (!audioBuffer) {
           return;
         }
-        return viewer.model?.speak(audioBuffer);
+        return viewer.model?.speak(audioBuffer, lip);
       }
     );
     prevSpeakPromise.then(() => {
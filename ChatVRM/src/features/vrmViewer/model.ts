@@ -3,7 +3,7 @@ import { VRM, VRMExpressionPresetName, VRMLoaderPlugin, VRMUtils } from "@pixiv/
 import { GLTFLoader } from "three/examples/jsm/loaders/GLTFLoader";
 import { VRMAnimation } from "../../lib/VRMAnimation/VRMAnimation";
 import { VRMLookAtSmootherLoaderPlugin } from "@/lib/VRMLookAtSmootherLoaderPlugin/VRMLookAtSmootherLoaderPlugin";
-import { LipSync } from "../lipSync/lipSync";
+import { LipEnvelope, LipSync } from "../lipSync/lipSync";
 import { EmoteController } from "../emoteController/emoteController";
 import { Screenplay } from "../messages/messages";
 
@@ -69,11 +69,34 @@ export class Model {
   /**
    * 音声を再生し、リップシンクを行う
    */
-  public async speak(buffer: ArrayBuffer) {
+  public async speak(buffer: ArrayBuffer, lip?: LipEnvelope) {
     // this.emoteController?.playEmotion(screenplay.expression);
     await new Promise((resolve) => {
       this._lipSync?.playFromArrayBuffer(buffer, () => {
         resolve(true);
+      }, lip);
+    });
+  }
+
+  /**
+   * 流式播放：开始、追加音频分片、等待全部播放完成
+   */
+  public startSpeakStream(sampleRate: number, onStart?: () => void, format?: string) {
+    this._lipSync?.startStream(sampleRate, onStart, format);
+  }
+
+  public appendSpeakStream(data: ArrayBuffer, lip?: LipEnvelope) {
+    this._lipSync?.appendStream(data, lip);
+  }
+
+  public async endSpeakStream() {
+    await new Promise((resolve) => {
+      if (!this._lipSync) {
+        resolve(true);
+        return;
+      }
+      this._lipSync.endStream(() => {
+        resolve(true);
       });
     });
   }
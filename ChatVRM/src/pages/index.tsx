@@ -7,6 +7,7 @@ import {
   Screenplay,
 } from "@/features/messages/messages";
 import { speakCharacter } from "@/features/messages/speakCharacter";
+import { LipEnvelope } from "@/features/lipSync/lipSync";
 import { SYSTEM_PROMPT } from "@/features/constants/systemPromptConstants";
 import { KoeiroParam, DEFAULT_PARAM } from "@/features/constants/koeiroParam";
 import { getChatResponseStream } from "@/features/chat/openAiChat";
@@ -15,6 +16,7 @@ import { Menu } from "@/components/menu";
 import { GitHubLink } from "@/components/githubLink";
 import { Meta } from "@/components/meta";
 import { VRMExpressionPresetName } from "@pixiv/three-vrm";
+import { decodeBinaryFrame, FrameMessage } from "@/utils/binaryFrame";
 
 export default function Home() {
   const { viewer } = useContext(ViewerContext);
@@ -32,6 +34,9 @@ export default function Home() {
   const reconnectAttemptsRef = useRef(0);
   const maxReconnectAttempts = 10; // 最大重连次数
   const reconnectDelay = 2000; // 初始重连延迟（毫秒）
+  // llm的情感结果可能晚于音频到达，按句子序号记下，并记录正在播放的句子
+  const emotionBySeqRef = useRef(new Map<number, VRMExpressionPresetName>());
+  const playingSeqRef = useRef<number | undefined>(undefined);
 
   // 从本地存储中加载参数
   useEffect(() => {
@@ -75,9 +80,10 @@ export default function Home() {
       // screenplay: Screenplay,
       audio_buffer: ArrayBuffer,
       onStart?: () => void,
-      onEnd?: () => void
+      onEnd?: () => void,
+      lip?: LipEnvelope
     ) => {
-      speakCharacter(audio_buffer, viewer, koeiromapKey, onStart, onEnd);
+      speakCharacter(audio_buffer, viewer, koeiromapKey, onStart, onEnd, lip);
     },
     [viewer, koeiromapKey]
   );
@@ -206,13 +212,48 @@ export default function Home() {
     [systemPrompt, chatLog, handleSpeakAi, openAiKey, koeiroParam]
   );
 
+  /**
+   * 播放完成后通知服务端
+   */
+  const sendPlaybackComplete = useCallback((seq?: number) => {
+    // 检查 WebSocket 是否存在且已打开
+    if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
+      // 回执带上句子序号，服务端据此匹配对应的句子
+      const completionMessage = {
+        type: "playback_complete",
+        content: "语音播放已完成",
+        seq,
+      };
+      wsRef.current.send(JSON.stringify(completionMessage));
+      console.log("发送播放完成信号:", completionMessage);
+    } else {
+      console.warn("WebSocket 未连接，无法发送播放完成信号。");
+    }
+  }, []);
+
   const emotions = ["neutral", "happy", "angry", "sad", "relaxed"] as const;
   type EmotionType =  VRMExpressionPresetName;
+
+  /**
+   * 某句开始播放时切换表情，已收到情感更新时以更新为准
+   */
+  const startEmotion = useCallback((tag: EmotionType, seq?: number) => {
+    playingSeqRef.current = seq;
+    let emotion = tag;
+    if (seq !== undefined) {
+      emotion = emotionBySeqRef.current.get(seq) ?? tag;
+      // 更早的句子已经播完，丢掉它们的记录
+      emotionBySeqRef.current.forEach((_, key) => {
+        if (key <= seq) emotionBySeqRef.current.delete(key);
+      });
+    }
+    viewer.model?.emoteController?.playEmotion(emotion);
+  }, [viewer]);
   /**
    * 与助手进行对话
    */
   const handleSendChat_test = useCallback(
-    async (tag: EmotionType,text: string,audio_buffer: ArrayBuffer) => {
+    async (tag: EmotionType,text: string,audio_buffer: ArrayBuffer, seq?: number, lip?: LipEnvelope) => {
       
       try {
         
@@ -223,28 +264,15 @@ export default function Home() {
 
           handleSpeakAi(audio_buffer,() =>{
             console.log("tag",tag);
-            viewer.model?.emoteController?.playEmotion(tag);
-          }, () => {
-            // 播放完成后的回调
-            // 检查 WebSocket 是否存在且已打开
-            if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
-              const completionMessage = {
-                type: "playback_complete",
-                content: "语音播放已完成",
-              };
-              wsRef.current.send(JSON.stringify(completionMessage));
-              console.log("发送播放完成信号:", completionMessage);
-            } else {
-              console.warn("WebSocket 未连接，无法发送播放完成信号。");
-            }
-          });
+            startEmotion(tag, seq);
+          }, () => sendPlaybackComplete(seq), lip);
       } catch (e) {
         setChatProcessing(false);
         console.error("语音处理过程中出错:", e); // 输出错误信息
       } 
       setChatProcessing(false);
     },
-    [systemPrompt, chatLog, handleSpeakAi, openAiKey, koeiroParam]
+    [systemPrompt, chatLog, handleSpeakAi, openAiKey, koeiroParam, sendPlaybackComplete, startEmotion]
   );
 
 
@@ -258,7 +286,9 @@ export default function Home() {
     const connectWebSocket = () => {
       if (!isMounted) return;
 
-      const ws = new WebSocket("ws://192.168.123.235:38024/ws");
+      // binary=1：音频以二进制帧接收，避免base64膨胀
+      // role=player：本页面负责播放并发送回执，第一个连接的播放端为主播放端
+      const ws = new WebSocket("ws://192.168.123.235:38024/ws?binary=1&role=player");
       wsRef.current = ws;
 
       ws.binaryType = "arraybuffer";
@@ -269,56 +299,79 @@ export default function Home() {
         reconnectAttemptsRef.current = 0;
       };
 
-      ws.onmessage = async (event) => {
-        if (typeof event.data === "string") {
-          try {
-            const message = JSON.parse(event.data);
-            const { type, content, data ,tag} = message;
-
-            switch (type) {
-              case "user_input":
-                console.log("接收到用户输入:", content);
-                handleSendChat(content);
-                break;
-              case "text":
-                console.log("接收到文本消息:", content);
-                // setChatLog((prevChatLog) => [
-                //   ...prevChatLog,
-                //   { role: "assistant", content },
-                // ]);
-                setAssistantMessage(content);
-                break;
-              case "text_audio":
-                console.log("接收到文本和音频消息:", content);
-                // setChatLog((prevChatLog) => [
-                //   ...prevChatLog,
-                //   { role: "assistant", content },
-                // ]);
-                // setAssistantMessage(content);
-                if (data) {
-                  // 假设音频数据是base64编码的字符串
-                  const audioBlob = base64ToBlob(data, "audio/mp3");
-                  // 转换为arraybuffer
-                  const audioBuffer = await audioBlob.arrayBuffer();
-                  
-                  handleSendChat_test(tag,content, audioBuffer);
-                }
-                break;
-              default:
-                console.warn("未知的消息类型:", type);
+      ws.onmessage = (event) => {
+        // 二进制帧直接携带音频；JSON帧为兼容模式，音频在base64的data字段中
+        let message: FrameMessage;
+        let payload: ArrayBuffer | null = null;
+        try {
+          if (typeof event.data === "string") {
+            message = JSON.parse(event.data);
+            if (message.data) {
+              payload = base64ToArrayBuffer(message.data);
             }
-          } catch (e) {
-            console.error("解析JSON消息时出错:", e);
+          } else if (event.data instanceof ArrayBuffer) {
+            ({ message, payload } = decodeBinaryFrame(event.data));
+          } else {
+            return;
           }
-        } else if (event.data instanceof ArrayBuffer) {
-          // 处理纯二进制消息（如果需要）
-          console.log("接收到二进制消息");
-          const audioBlob = new Blob([event.data], { type: "audio/mp3" });
-          const audioUrl = URL.createObjectURL(audioBlob);
-          const audio = new Audio(audioUrl);
-          audio.play().catch((error) =>
-            console.error("音频播放失败:", error)
-          );
+        } catch (e) {
+          console.error("解析消息时出错:", e);
+          return;
+        }
+
+        const { type, content, tag, seq } = message;
+        switch (type) {
+          case "user_input":
+            console.log("接收到用户输入:", content);
+            handleSendChat(content as string);
+            break;
+          case "text":
+            console.log("接收到文本消息:", content);
+            // setChatLog((prevChatLog) => [
+            //   ...prevChatLog,
+            //   { role: "assistant", content },
+            // ]);
+            setAssistantMessage(content as string);
+            break;
+          case "text_audio":
+            console.log("接收到文本和音频消息:", content);
+            // setChatLog((prevChatLog) => [
+            //   ...prevChatLog,
+            //   { role: "assistant", content },
+            // ]);
+            // setAssistantMessage(content);
+            if (payload && payload.byteLength > 0) {
+              handleSendChat_test(tag as EmotionType, content as string, payload, seq, message.lip);
+            }
+            break;
+          case "text_audio_start":
+            // 流式音频：可能在上一句播完前就收到，表情在实际开始播放时切换
+            console.log("接收到流式音频开始:", content);
+            viewer.model?.startSpeakStream(message.sample_rate, () => {
+              startEmotion(tag as EmotionType, seq);
+            }, message.format);
+            break;
+          case "audio_chunk":
+            if (payload) {
+              // 同步处理，保证分片按到达顺序排队播放
+              viewer.model?.appendSpeakStream(payload, message.lip);
+            }
+            break;
+          case "emotion":
+            // 服务端先按本地判断开始播放，llm的情感结果到达后补发；该句正在播放则立即切换
+            if (seq !== undefined && (playingSeqRef.current === undefined || seq >= playingSeqRef.current)) {
+              emotionBySeqRef.current.set(seq, tag as EmotionType);
+              if (playingSeqRef.current === seq) {
+                viewer.model?.emoteController?.playEmotion(tag as EmotionType);
+              }
+            }
+            break;
+          case "text_audio_end":
+            console.log("流式音频接收完成:", content);
+            viewer.model?.endSpeakStream().then(() => sendPlaybackComplete(seq));
+            break;
+          default:
+            console.warn("未知的消息类型:", type);
         }
       };
 
@@ -357,19 +410,17 @@ export default function Home() {
   }, []);
 
   /**
-   * 将base64字符串转换为Blob对象
+   * 将base64字符串转换为ArrayBuffer（JSON兼容模式）
    * @param base64
-   * @param mime
-   * @returns Blob
+   * @returns ArrayBuffer
    */
-  const base64ToBlob = (base64: string, mime: string) => {
+  const base64ToArrayBuffer = (base64: string) => {
     const byteCharacters = atob(base64);
-    const byteNumbers = new Array(byteCharacters.length);
+    const byteArray = new Uint8Array(byteCharacters.length);
     for (let i = 0; i < byteCharacters.length; i++) {
-      byteNumbers[i] = byteCharacters.charCodeAt(i);
+      byteArray[i] = byteCharacters.charCodeAt(i);
     }
-    const byteArray = new Uint8Array(byteNumbers);
-    return new Blob([byteArray], { type: mime });
+    return byteArray.buffer;
   };
 
 
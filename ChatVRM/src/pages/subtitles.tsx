@@ -25,7 +25,7 @@ const SubtitlesPage = () => {
       wsRef.current.onmessage = (event) => {
         try {
           const message = JSON.parse(event.data);
-          if (message.type === "text_audio") {
+          if (message.type === "text_audio" || message.type === "text_audio_start") {
             const { content } = message;
             if (typeof content === "object" && content !== null) {
               const { tag, text } = content;
@@ -0,0 +1,24 @@
+/**
+ * 服务端二进制帧：4字节大端头长度 + UTF-8 JSON元数据 + 原始音频字节
+ */
+export type FrameMessage = {
+  type: string;
+  content?: string;
+  tag?: string;
+  seq?: number;
+  data?: string;
+  [key: string]: any;
+};
+
+const textDecoder = new TextDecoder("utf-8");
+
+export function decodeBinaryFrame(buffer: ArrayBuffer): {
+  message: FrameMessage;
+  payload: ArrayBuffer;
+} {
+  const headerLength = new DataView(buffer).getUint32(0, false);
+  const header = new Uint8Array(buffer, 4, headerLength);
+  const message = JSON.parse(textDecoder.decode(header));
+  const payload = buffer.slice(4 + headerLength);
+  return { message, payload };
+}
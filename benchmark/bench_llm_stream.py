@@ -0,0 +1,91 @@
+# bench_llm_stream.py
+# 验证 app3d 的llm流式输出不会阻塞事件循环：
+# 在本地模拟服务上流式生成回复的同时，用心跳任务测量事件循环的调度延迟
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+import openai
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app3d  # noqa: E402
+from benchmark.fake_openai_server import create_app  # noqa: E402
+
+
+async def heartbeat(interval: float, lags: list, stop: asyncio.Event):
+    """
+    每interval秒醒来一次，记录实际醒来时间与预期时间的偏差
+    """
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - expected)
+
+
+async def main(args):
+    server = uvicorn.Server(uvicorn.Config(
+        create_app(token_rate=args.token_rate, first_token_delay=args.first_token_delay),
+        host="127.0.0.1", port=args.port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    app3d.logger = logging.getLogger("llm")
+    app3d.model_name = "fake"
+    app3d.openai_client = openai.AsyncOpenAI(api_key="aaa", base_url=f"http://127.0.0.1:{args.port}/v1")
+    app3d.llm_cache_hints = {}
+    app3d.metrics = app3d.Metrics()
+
+    lags = []
+    stop = asyncio.Event()
+    beat = asyncio.create_task(heartbeat(args.interval, lags, stop))
+
+    start = time.perf_counter()
+    first_token = None
+    token_times = []
+    async for token, _ in app3d.stream_llm_tokens([{"role": "user", "content": "你好"}]):
+        now = time.perf_counter()
+        if token:
+            if first_token is None:
+                first_token = now - start
+            token_times.append(now)
+    total = time.perf_counter() - start
+
+    stop.set()
+    await beat
+    server.should_exit = True
+    await server_task
+
+    lags.sort()
+    gaps = sorted(b - a for a, b in zip(token_times, token_times[1:]))
+    result = {
+        "tokens": len(token_times),
+        "first_token_s": round(first_token or 0.0, 4),
+        "total_s": round(total, 4),
+        "token_gap_p50_ms": round(gaps[len(gaps) // 2] * 1000, 2) if gaps else 0.0,
+        "loop_lag_p50_ms": round(lags[len(lags) // 2] * 1000, 2) if lags else 0.0,
+        "loop_lag_max_ms": round(lags[-1] * 1000, 2) if lags else 0.0,
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="llm流式输出事件循环延迟测试")
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--token-rate", type=float, default=50.0)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--interval", type=float, default=0.01, help="心跳间隔（秒）")
+    parser.add_argument("--max-lag-ms", type=float, default=50.0, help="事件循环最大允许延迟")
+    args = parser.parse_args()
+
+    result = asyncio.run(main(args))
+    # 同步客户端会让心跳在整段回复期间停摆，超过阈值视为失败
+    sys.exit(0 if result["loop_lag_max_ms"] <= args.max_lag_ms else 1)
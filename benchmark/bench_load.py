@@ -0,0 +1,381 @@
+# bench_load.py
+# 离线压测：启动模拟llm和模拟TTS，把app3d作为子进程指向它们，用N个模拟观众连接WebSocket并回执播放，
+# 按可调倍速回放录制的弹幕，最后以JSON输出吞吐、各阶段延迟分位数、丢弃率和句间空隙
+# 指定阈值时超出即退出码为1，可以放进CI检查性能回退
+#
+# 用法: python benchmark/bench_load.py --rate 4 --clients 3 --output report.json
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import aiohttp
+import uvicorn
+
+from fake_openai_server import create_app as create_llm_app
+from fake_tts_server import create_app as create_tts_app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRACE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "danmaku_trace.jsonl")
+
+
+def percentiles(values: list) -> dict:
+    values = sorted(values)
+    pick = lambda p: round(values[min(int(len(values) * p), len(values) - 1)], 4) if values else None
+    return {"count": len(values), "p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99),
+            "max": round(values[-1], 4) if values else None}
+
+
+def wav_duration(data: bytes) -> float:
+    """
+    模拟TTS返回的是44字节头的16bit单声道WAV
+    """
+    if len(data) < 44 or data[:4] != b"RIFF":
+        return 0.0
+    byte_rate = struct.unpack_from("<I", data, 28)[0]
+    return (len(data) - 44) / byte_rate if byte_rate else 0.0
+
+
+class SimulatedViewer:
+    """
+    模拟一个客户端：按顺序排队"播放"收到的音频，播放端在每句结束时发送带序号的回执
+    同时统计同一条回复内相邻两句之间的空隙和流式播放的断流
+    """
+    def __init__(self, name: str, player: bool, binary: bool):
+        self.name = name
+        self.player = player
+        self.binary = binary
+        self.ws = None
+        self.clock = 0.0  # 已排队音频的播放结束时间（monotonic）
+        self.last_trace = None  # 上一句所属的trace，用于区分句间空隙和回复之间的空闲
+        self.stream_start = None
+        self.stream_sample_rate = None
+        self.stream_meta = {}
+        self.stream_audio = 0.0
+        self.stats = {"messages": 0, "bytes": 0, "sentences": 0, "audio_seconds": 0.0,
+                      "underruns": 0, "stall_seconds": 0.0, "acks": 0, "connected": False,
+                      "disconnected": False, "error": None}
+        self.gaps = []
+        self.ack_tasks = set()
+
+    @staticmethod
+    def decode(message) -> tuple:
+        if message.type == aiohttp.WSMsgType.BINARY:
+            data = message.data
+            size = struct.unpack_from(">I", data)[0]
+            return json.loads(data[4:4 + size]), data[4 + size:]
+        meta = json.loads(message.data)
+        payload = base64.b64decode(meta.pop("data")) if "data" in meta else b""
+        return meta, payload
+
+    def _begin(self, meta: dict, now: float) -> float:
+        """
+        新的一句开始播放的时间：前面的音频播完之后
+        """
+        start = max(now, self.clock)
+        if self.last_trace is not None and meta.get("trace") == self.last_trace:
+            self.gaps.append(start - self.clock)
+        self.last_trace = meta.get("trace")
+        return start
+
+    def _finish(self, seq: int, end: float, seconds: float):
+        self.clock = end
+        self.stats["sentences"] += 1
+        self.stats["audio_seconds"] += seconds
+        if self.player:
+            task = asyncio.create_task(self._ack(seq, end))
+            self.ack_tasks.add(task)
+            task.add_done_callback(self.ack_tasks.discard)
+
+    async def _ack(self, seq: int, end: float):
+        await asyncio.sleep(max(end - time.monotonic(), 0))
+        if self.ws is not None and not self.ws.closed:
+            await self.ws.send_str(json.dumps({"type": "playback_complete", "seq": seq}))
+            self.stats["acks"] += 1
+
+    def on_message(self, meta: dict, payload: bytes, now: float):
+        message_type = meta.get("type")
+        if message_type == "text_audio":
+            seconds = wav_duration(payload)
+            start = self._begin(meta, now)
+            self._finish(meta["seq"], start + seconds, seconds)
+        elif message_type == "text_audio_start":
+            self.stream_sample_rate = meta["sample_rate"]
+            self.stream_meta = meta
+            self.stream_start = None
+        elif message_type == "audio_chunk" and self.stream_sample_rate:
+            # 压缩格式的分片是完整的音频文件，时长由服务端给出
+            seconds = meta.get("duration") or len(payload) / (self.stream_sample_rate * 2)
+            if self.stream_start is None:
+                self.stream_start = self._begin(self.stream_meta, now)
+                self.clock = self.stream_start
+                self.stream_audio = 0.0
+            elif now > self.clock:
+                # 分片到达时前面的已经播完，出现断流
+                self.stats["underruns"] += 1
+                self.stats["stall_seconds"] += now - self.clock
+                self.clock = now
+            self.clock += seconds
+            self.stream_audio += seconds
+        elif message_type == "text_audio_end" and self.stream_start is not None:
+            self._finish(meta["seq"], self.clock, self.stream_audio)
+            self.stream_start = None
+
+    async def run(self, session: aiohttp.ClientSession, url: str):
+        query = "?binary=1" if self.binary else "?binary=0"
+        if self.player:
+            query += "&role=player"
+        try:
+            async with session.ws_connect(url + query, max_msg_size=0) as ws:
+                self.ws = ws
+                self.stats["connected"] = True
+                async for message in ws:
+                    if message.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                        break
+                    self.stats["messages"] += 1
+                    self.stats["bytes"] += len(message.data)
+                    meta, payload = self.decode(message)
+                    self.on_message(meta, payload, time.monotonic())
+        except aiohttp.ClientError as e:
+            # 连接失败（例如服务端没有安装websockets）要在报告里体现，而不是静默地没有数据
+            self.stats["error"] = repr(e)
+        self.stats["disconnected"] = True
+
+    def summary(self) -> dict:
+        return {"name": self.name, "player": self.player, "binary": self.binary,
+                **{k: round(v, 3) if isinstance(v, float) else v for k, v in self.stats.items()},
+                "gaps": percentiles(self.gaps)}
+
+
+def parse_metrics(text: str) -> dict:
+    """
+    只取不带标签的指标值
+    """
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#") and "{" not in line:
+            name, _, value = line.partition(" ")
+            values[name] = float(value)
+    return values
+
+
+async def start_server(app, port: int) -> tuple:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+async def wait_ready(session: aiohttp.ClientSession, base: str, process, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            raise RuntimeError(f"app3d启动失败，退出码{process.returncode}")
+        try:
+            async with session.get(base + "/metrics") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"app3d在{timeout}秒内没有就绪")
+
+
+async def replay(session: aiohttp.ClientSession, base: str, trace: list, rate: float, loops: int) -> dict:
+    """
+    按录制时间的1/rate回放弹幕，通过 /admin_input/ 注入调度器
+    """
+    sent = {"inputs": 0, "errors": 0}
+    start = time.monotonic()
+    span = trace[-1]["t"] if trace else 0.0
+    for loop in range(loops):
+        for item in trace:
+            delay = start + (loop * span + item["t"]) / rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            body = {key: item[key] for key in ("type", "text", "user") if key in item}
+            try:
+                async with session.post(base + "/admin_input/", json=body) as response:
+                    result = await response.json()
+                ok = result.get("status") == "success"
+            except aiohttp.ClientError:
+                ok = False
+            sent["inputs" if ok else "errors"] += 1
+    return sent
+
+
+async def drain(session: aiohttp.ClientSession, base: str, viewers: list, idle: float, timeout: float):
+    """
+    等调度器清空、llm_main空闲，且所有客户端idle秒内没有收到新消息
+    只看客户端消息不够：llm生成和首句合成期间客户端也可能几秒收不到消息
+    """
+    deadline = time.monotonic() + timeout
+    last_count, last_change = None, time.monotonic()
+    while time.monotonic() < deadline:
+        count = sum(viewer.stats["messages"] for viewer in viewers)
+        if count != last_count:
+            last_count, last_change = count, time.monotonic()
+        async with session.get(base + "/metrics") as response:
+            values = parse_metrics(await response.text())
+        busy = values.get("main_queue_depth", 0) or values.get("llm_busy", 0)
+        if not busy and time.monotonic() - last_change >= idle:
+            return True
+        await asyncio.sleep(0.5)
+    return False
+
+
+async def main(args) -> bool:
+    trace = [json.loads(line) for line in open(args.trace, encoding="utf-8") if line.strip()]
+    llm_server = await start_server(create_llm_app(token_rate=args.token_rate, first_token_delay=args.first_token_delay,
+                                                   numbered=True), args.llm_port)
+    tts_server = await start_server(create_tts_app(latency=args.tts_latency, rtf=args.tts_rtf,
+                                                   concurrency=args.tts_concurrency), args.tts_port)
+
+    books_dir = tempfile.mkdtemp(prefix="bench_load_books_")  # 空书库，不让读书模块干扰
+    env = dict(os.environ,
+               TTS_URL=f"http://127.0.0.1:{args.tts_port}/tts/",
+               LLM_BASE_URL=f"http://127.0.0.1:{args.llm_port}/v1",
+               LLM_MODEL="fake",
+               LIVE_ROOM_ID="0",
+               TTS_CACHE_DIR="",
+               EBOOK_DIR=books_dir,
+               PORT=str(args.port))
+    log = open(args.log, "wb")
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, "app3d.py"),
+                                                   cwd=ROOT, env=env, stdout=log, stderr=asyncio.subprocess.STDOUT)
+    base = f"http://127.0.0.1:{args.port}"
+    viewers = [SimulatedViewer(f"viewer-{i}", player=i < args.players, binary=i % 2 == 0)
+               for i in range(args.clients)]
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_ready(session, base, process, args.startup_timeout)
+            viewer_tasks = [asyncio.create_task(viewer.run(session, base.replace("http", "ws") + "/ws"))
+                            for viewer in viewers]
+            await asyncio.sleep(0.5)
+
+            start = time.monotonic()
+            sent = await replay(session, base, trace, args.rate, args.loops)
+            drained = await drain(session, base, viewers, args.idle, args.drain_timeout)
+            elapsed = time.monotonic() - start
+
+            async with session.get(base + "/trace_stats/") as response:
+                latency = await response.json()
+            async with session.get(base + "/danmaku_stats/") as response:
+                danmaku = await response.json()
+            async with session.get(base + "/playback_stats/") as response:
+                playback = await response.json()
+            async with session.get(base + "/metrics") as response:
+                metrics = parse_metrics(await response.text())
+            async with session.get(f"http://127.0.0.1:{args.tts_port}/stats/") as response:
+                tts = await response.json()
+
+            for viewer in viewers:
+                if viewer.ws is not None:
+                    await viewer.ws.close()
+            await asyncio.gather(*viewer_tasks, return_exceptions=True)
+    finally:
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
+        log.close()
+        for server, task in (llm_server, tts_server):
+            server.should_exit = True
+            await task
+
+    player = viewers[0].summary() if viewers else {}
+    received = danmaku.get("received", 0)
+    dropped = danmaku.get("dropped_full", 0) + danmaku.get("dropped_stale", 0)
+    replies = latency.get("pipeline_playback_ack_seconds", {}).get("count", 0)
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "log")},
+        "drained": drained,
+        "elapsed_s": round(elapsed, 3),
+        "throughput": {
+            "inputs_sent": sent["inputs"],
+            "input_errors": sent["errors"],
+            "inputs_per_s": round(sent["inputs"] / elapsed, 3) if elapsed else 0.0,
+            "replies_completed": replies,
+            "replies_per_s": round(replies / elapsed, 3) if elapsed else 0.0,
+            "sentences_played": player.get("sentences", 0),
+            "audio_seconds_played": player.get("audio_seconds", 0.0),
+            "tts_requests": tts["requests"],
+        },
+        "latency": latency,
+        "drops": {
+            "received": received,
+            "merged": danmaku.get("merged", 0),
+            "dropped_full": danmaku.get("dropped_full", 0),
+            "dropped_stale": danmaku.get("dropped_stale", 0),
+            "drop_rate": round(dropped / received, 4) if received else 0.0,
+            "ws_dropped_messages": metrics.get("websocket_dropped_messages", 0),
+            "ws_slow_disconnects": metrics.get("websocket_slow_disconnects", 0),
+        },
+        "gaps": {
+            "client": player.get("gaps", {}),
+            "underruns": player.get("underruns", 0),
+            "stall_s": player.get("stall_seconds", 0.0),
+            "server": playback,
+        },
+        "viewers": [viewer.summary() for viewer in viewers],
+    }
+
+    e2e_p95 = report["latency"].get("pipeline_playback_ack_seconds", {}).get("p95")
+    first_audio_p95 = report["latency"].get("pipeline_broadcast_seconds", {}).get("p95")
+    gap_p95 = report["gaps"]["client"].get("p95")
+    checks = {
+        "drained": drained,
+        "no_input_errors": sent["errors"] == 0,
+        "viewers_connected": all(viewer.stats["connected"] for viewer in viewers),
+        "replies_completed": replies > 0,
+    }
+    if args.max_e2e_p95 is not None:
+        checks["e2e_p95"] = e2e_p95 is not None and e2e_p95 <= args.max_e2e_p95
+    if args.max_first_audio_p95 is not None:
+        checks["first_audio_p95"] = first_audio_p95 is not None and first_audio_p95 <= args.max_first_audio_p95
+    if args.max_drop_rate is not None:
+        checks["drop_rate"] = report["drops"]["drop_rate"] <= args.max_drop_rate
+    if args.max_gap_p95 is not None:
+        checks["gap_p95"] = gap_p95 is None or gap_p95 <= args.max_gap_p95
+    report["checks"] = checks
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    return all(checks.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="app3d离线压测")
+    parser.add_argument("--trace", default=TRACE, help="每行一个{t, type, text, user}的jsonl弹幕记录")
+    parser.add_argument("--rate", type=float, default=4.0, help="回放倍速")
+    parser.add_argument("--loops", type=int, default=1, help="回放遍数")
+    parser.add_argument("--clients", type=int, default=3, help="模拟观众数")
+    parser.add_argument("--players", type=int, default=1, help="其中负责回执的播放端数")
+    parser.add_argument("--token-rate", type=float, default=50.0)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--tts-rtf", type=float, default=0.3)
+    parser.add_argument("--tts-concurrency", type=int, default=1)
+    parser.add_argument("--port", type=int, default=38124)
+    parser.add_argument("--llm-port", type=int, default=38125)
+    parser.add_argument("--tts-port", type=int, default=38126)
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--idle", type=float, default=3.0, help="客户端多少秒没收到消息视为处理完毕")
+    parser.add_argument("--drain-timeout", type=float, default=300.0)
+    parser.add_argument("--max-e2e-p95", type=float, default=None, help="接收到播放完成的p95上限（秒）")
+    parser.add_argument("--max-first-audio-p95", type=float, default=None, help="接收到首句下发的p95上限（秒）")
+    parser.add_argument("--max-drop-rate", type=float, default=None)
+    parser.add_argument("--max-gap-p95", type=float, default=None, help="同一回复内句间空隙的p95上限（秒）")
+    parser.add_argument("--output", default=None, help="报告另存为json文件")
+    parser.add_argument("--log", default=os.path.join(tempfile.gettempdir(), "bench_load_app3d.log"),
+                        help="app3d子进程的日志")
+    sys.exit(0 if asyncio.run(main(parser.parse_args())) else 1)
@@ -0,0 +1,136 @@
+# bench_segmenter.py
+# 用录制的token流回放分句过程：对比旧的逐token拼接+正则分句与SentenceSegmenter的首句延迟、句长和耗时
+# 同时检查切出的句子拼起来与回答原文一致、思考内容没有泄漏，检查失败时退出码为1
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app3d  # noqa: E402
+
+app3d.reasoning_log = deque(maxlen=8)
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "token_streams.jsonl")
+
+
+def legacy_segment(tokens: list):
+    """
+    原chat_openai中的分句逻辑，只识别整个token等于<think>/</think>的情况
+    返回[(切出时已收到的token数, 句子), ...]
+    """
+    result = []
+    current_sentence = ""
+    think = False
+    for i, token in enumerate(tokens):
+        finish_reason = "stop" if i == len(tokens) - 1 else None
+        if token == "<think>":
+            think = True
+            continue
+        if token == "</think>":
+            think = False
+            continue
+        if think:
+            continue
+        current_sentence += token
+        if (len(current_sentence) < 30 and (not re.search(r"[。\?？\!！…~]", current_sentence))
+                or len(current_sentence) < 10) \
+                and finish_reason != "stop":
+            continue
+        if re.search(r"[。\?？\!！;；,，…~]+", token) or finish_reason == "stop":
+            current_sentence = current_sentence.strip()
+            if current_sentence:
+                result.append((i + 1, current_sentence))
+                current_sentence = ""
+    return result
+
+
+def new_segment(tokens: list):
+    """
+    与chat_openai相同的ReasoningFilter + SentenceSegmenter组合
+    返回[(切出时已收到的token数, 句子), ...]和思考内容
+    """
+    result = []
+    reasoning = app3d.ReasoningFilter(log_chars=1 << 20)
+    segmenter = app3d.SentenceSegmenter()
+    for i, token in enumerate(tokens):
+        text = reasoning.feed(token)
+        if text:
+            sentences = segmenter.feed(text)
+            if sentences:
+                result.extend((i + 1, sentence) for sentence in sentences)
+    tail = reasoning.finish()
+    result.extend((len(tokens), sentence) for sentence in segmenter.feed(tail) + segmenter.flush())
+    return result, "".join(reasoning.kept)
+
+
+def answer_text(tokens: list) -> str:
+    """
+    回答原文（去掉思考部分和空白），用于校验
+    """
+    text = re.sub(r"<think>.*?</think>", "", "".join(tokens), flags=re.S)
+    return re.sub(r"\s+", "", text)
+
+
+def first_answer(sentences: list, answer: str):
+    """
+    第一句不含思考内容的句子，旧逻辑会把没识别出的思考内容当成第一句念出来，不能算作更早出声
+    """
+    for index, sentence in sentences:
+        if re.sub(r"\s+", "", sentence) in answer:
+            return index, sentence
+    return None, None
+
+
+def timed(segment, tokens: list, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        segment(tokens)
+    return (time.perf_counter() - start) / repeat / len(tokens)
+
+
+def main(args):
+    streams = [json.loads(line) for line in open(args.data, encoding="utf-8") if line.strip()]
+    ok = True
+    results = []
+    for stream in streams:
+        tokens = stream["tokens"]
+        legacy = legacy_segment(tokens)
+        new, think = new_segment(tokens)
+        joined = re.sub(r"\s+", "", "".join(sentence for _, sentence in new))
+        answer = answer_text(tokens)
+        legacy_answer_token, legacy_answer = first_answer(legacy, answer)
+        checks = {
+            "text_preserved": joined == answer,
+            "no_think_leak": "think>" not in joined and (not think or think.strip() not in joined),
+        }
+        ok = ok and all(checks.values())
+        results.append({
+            "name": stream["name"],
+            "tokens": len(tokens),
+            "legacy_first_sentence_token": legacy[0][0] if legacy else None,
+            "new_first_sentence_token": new[0][0] if new else None,
+            "legacy_first_sentence": legacy[0][1] if legacy else None,
+            "new_first_sentence": new[0][1] if new else None,
+            "legacy_first_answer_token": legacy_answer_token,
+            "legacy_first_answer": legacy_answer,
+            "legacy_sentences": len(legacy),
+            "new_sentences": len(new),
+            "legacy_us_per_token": round(timed(legacy_segment, tokens, args.repeat) * 1e6, 2),
+            "new_us_per_token": round(timed(new_segment, tokens, args.repeat) * 1e6, 2),
+            **checks,
+        })
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="分句器回放基准")
+    parser.add_argument("--data", default=DATA, help="每行一个{name, tokens}的jsonl文件")
+    parser.add_argument("--repeat", type=int, default=200)
+    sys.exit(0 if main(parser.parse_args()) else 1)
@@ -0,0 +1,62 @@
+# bench_ws_framing.py
+# 对比 JSON+base64 与二进制帧两种音频下发方式的编码耗时和传输字节数
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app3d  # noqa: E402
+
+
+def make_wav(seconds: float, sample_rate: int = 44100) -> bytes:
+    """
+    生成指定时长的16bit单声道WAV（内容为伪随机噪声，避免被压缩特殊优化）
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(os.urandom(int(seconds * sample_rate) * 2))
+    return buffer.getvalue()
+
+
+def bench(encode, meta: dict, payload: bytes, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encode(meta, payload)
+    return (time.perf_counter() - start) / repeat
+
+
+def main(args):
+    meta = {"type": "text_audio", "content": "大家好呀，我是丧彪！今天的直播马上开始。", "tag": "happy", "seq": 1}
+    results = []
+    for seconds in args.seconds:
+        payload = make_wav(seconds)
+        json_frame = app3d.encode_json_frame(meta, payload)
+        binary_frame = app3d.encode_binary_frame(meta, payload)
+        json_s = bench(app3d.encode_json_frame, meta, payload, args.repeat)
+        binary_s = bench(app3d.encode_binary_frame, meta, payload, args.repeat)
+        results.append({
+            "clip_s": seconds,
+            "audio_bytes": len(payload),
+            "json_bytes": len(json_frame.encode("utf-8")),
+            "binary_bytes": len(binary_frame),
+            "json_encode_ms": round(json_s * 1000, 3),
+            "binary_encode_ms": round(binary_s * 1000, 3),
+            "speedup": round(json_s / binary_s, 1) if binary_s else None,
+        })
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WebSocket音频帧编码基准")
+    parser.add_argument("--seconds", type=float, nargs="+", default=[3.0, 5.0, 10.0])
+    parser.add_argument("--repeat", type=int, default=50)
+    main(parser.parse_args())
@@ -0,0 +1,125 @@
+# fake_openai_server.py
+# 本地模拟的 openai 兼容服务，用于在没有 ollama 的情况下压测 app3d
+
+import argparse
+import asyncio
+import json
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+
+DEFAULT_REPLY = "大家好呀，我是丧彪！今天的直播马上开始，欢迎新来的朋友们。有什么想聊的尽管发弹幕，我都会认真回复的哦～"
+
+
+def create_app(token_rate: float = 50.0, reply: str = DEFAULT_REPLY,
+               first_token_delay: float = 0.2, emotion: str = "happy", numbered: bool = False) -> FastAPI:
+    """
+    创建模拟服务
+    token_rate: 每秒输出的token数
+    first_token_delay: 首token延迟（秒），模拟prefill耗时
+    numbered: 每次流式回复前加上序号，避免相同的回复全部命中TTS缓存
+    """
+    app = FastAPI()
+    requests = {"stream": 0}
+
+    def _chunk(model: str, content: str = None, finish_reason: str = None) -> str:
+        delta = {} if content is None else {"role": "assistant", "content": content}
+        data = {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    async def _stream(model: str, usage: dict = None):
+        requests["stream"] += 1
+        text = f"这是第{requests['stream']}条回复。{reply}" if numbered else reply
+        await asyncio.sleep(first_token_delay)
+        for token in text:
+            yield _chunk(model, token)
+            await asyncio.sleep(1.0 / token_rate)
+        yield _chunk(model, finish_reason="stop")
+        if usage is not None:
+            usage = dict(usage, completion_tokens=len(text), total_tokens=usage["prompt_tokens"] + len(text))
+            data = {"id": f"chatcmpl-{uuid.uuid4().hex[:8]}", "object": "chat.completion.chunk",
+                    "created": int(time.time()), "model": model, "choices": [], "usage": usage}
+            yield f"data: {json.dumps(data)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    def _arguments(tool: dict, messages: list) -> dict:
+        """
+        按请求的工具参数定义构造调用参数：字符串参数填emotion，
+        数组参数按最后一条用户消息中编号句子（"1. ..."）的数量填充，取值不在enum中时取enum的第一项
+        """
+        user = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+        count = len(re.findall(r"^\d+\. ", user, flags=re.M)) or 1
+        arguments = {}
+        for name, schema in tool["function"].get("parameters", {}).get("properties", {}).items():
+            enum = (schema.get("items") or schema).get("enum")
+            value = emotion if not enum or emotion in enum else enum[0]
+            arguments[name] = [value] * count if schema.get("type") == "array" else value
+        return arguments
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "fake")
+        if body.get("stream"):
+            # 请求include_usage时在末尾返回用量，输入按每字1个token加每条消息4个token计算
+            usage = None
+            if (body.get("stream_options") or {}).get("include_usage"):
+                usage = {"prompt_tokens": sum(len(m.get("content") or "") + 4 for m in body.get("messages", []))}
+            return StreamingResponse(_stream(model, usage), media_type="text/event-stream")
+
+        # 非流式请求：有tools时按所请求工具的名字和参数定义返回调用，否则直接返回完整回复
+        message = {"role": "assistant", "content": reply}
+        finish_reason = "stop"
+        if body.get("tools"):
+            tool = body["tools"][0]
+            choice = body.get("tool_choice")
+            if isinstance(choice, dict):
+                tool = next((t for t in body["tools"] if t["function"]["name"] == choice["function"]["name"]), tool)
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:8]}",
+                    "type": "function",
+                    "function": {
+                        "name": tool["function"]["name"],
+                        "arguments": json.dumps(_arguments(tool, body.get("messages", []))),
+                    },
+                }],
+            }
+            finish_reason = "tool_calls"
+        await asyncio.sleep(first_token_delay)
+        return JSONResponse({
+            "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(reply), "total_tokens": len(reply)},
+        })
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="openai兼容的模拟llm服务")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--token-rate", type=float, default=50.0)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--numbered", action="store_true", help="每次回复前加序号")
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(token_rate=args.token_rate, first_token_delay=args.first_token_delay,
+                           numbered=args.numbered),
+                host="127.0.0.1", port=args.port)
@@ -0,0 +1,92 @@
+# fake_tts_server.py
+# 本地模拟的 fish_speech /tts/ 服务，返回合成的正弦波WAV，用于在没有GPU的情况下压测 app3d
+
+import argparse
+import asyncio
+import math
+import struct
+
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+import uvicorn
+
+
+def wav_header(sample_rate: int, data_size: int) -> bytes:
+    """
+    16bit单声道PCM的44字节WAV头，流式时data_size填0xFFFFFFFF
+    """
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", min(36 + data_size, 0xFFFFFFFF), b"WAVE",
+                       b"fmt ", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16, b"data", data_size)
+
+
+def tone(sample_rate: int, seconds: float, frequency: float = 220.0) -> bytes:
+    """
+    指定时长的正弦波PCM，音量足以让口型包络有变化
+    """
+    period = [int(8000 * math.sin(2 * math.pi * i * frequency / sample_rate))
+              for i in range(int(sample_rate / frequency))]
+    samples = int(sample_rate * seconds)
+    repeated = period * (samples // len(period) + 1)
+    return struct.pack(f"<{samples}h", *repeated[:samples])
+
+
+def create_app(latency: float = 0.3, rtf: float = 0.3, seconds_per_char: float = 0.22,
+               sample_rate: int = 44100, chunk_seconds: float = 0.2, concurrency: int = 1) -> FastAPI:
+    """
+    创建模拟服务
+    latency: 每个请求开始出声前的固定耗时（秒）
+    rtf: 实时率，合成1秒音频需要的秒数
+    seconds_per_char: 每个字对应的音频时长
+    concurrency: 同时合成的请求数，模拟单卡推理的串行
+    """
+    app = FastAPI()
+    engine = asyncio.Semaphore(concurrency)
+    stats = {"requests": 0, "streaming": 0, "audio_seconds": 0.0}
+
+    @app.post("/tts/")
+    async def tts(request: Request):
+        body = await request.json()
+        text = body.get("text", "")
+        streaming = str(body.get("streaming", False)).lower() == "true"
+        seconds = max(len(text) * seconds_per_char, chunk_seconds)
+        stats["requests"] += 1
+        stats["audio_seconds"] += seconds
+
+        if not streaming:
+            async with engine:
+                await asyncio.sleep(latency + seconds * rtf)
+            pcm = tone(sample_rate, seconds)
+            return Response(wav_header(sample_rate, len(pcm)) + pcm, media_type="audio/wav")
+
+        stats["streaming"] += 1
+
+        async def stream():
+            async with engine:
+                await asyncio.sleep(latency)
+                yield wav_header(sample_rate, 0xFFFFFFFF)
+                remaining = seconds
+                while remaining > 0:
+                    part = min(chunk_seconds, remaining)
+                    await asyncio.sleep(part * rtf)
+                    yield tone(sample_rate, part)
+                    remaining -= part
+
+        return StreamingResponse(stream(), media_type="audio/wav")
+
+    @app.get("/stats/")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fish_speech兼容的模拟TTS服务")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--rtf", type=float, default=0.3)
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(latency=args.latency, rtf=args.rtf, concurrency=args.concurrency),
+                host="127.0.0.1", port=args.port)
@@ -0,0 +1,58 @@
+# audio_clips.py
+# 压缩格式的流式音频：每个分句单独编码成一个完整的音频文件（可以直接解码播放），连同口型包络逐个下发
+# fish_speech服务和app3d共用
+#
+# 流的格式：流头（CLIP、原始采样率、口型帧率、格式名），之后每个分句一帧：
+# 帧头（包络字节数、音频字节数、原始采样点数） + 口型包络 + 编码后的音频
+
+import struct
+from typing import List, Tuple
+
+CLIP_MAGIC = b"CLIP"
+STREAM_HEADER = struct.Struct(">4sIf8s")
+FRAME_HEADER = struct.Struct(">III")
+
+
+def stream_header(sample_rate: int, lip_fps: float, audio_format: str) -> bytes:
+    return STREAM_HEADER.pack(CLIP_MAGIC, sample_rate, lip_fps, audio_format.encode("ascii"))
+
+
+def parse_stream_header(data: bytes) -> Tuple[int, float, str]:
+    """
+    返回(采样率, 口型帧率, 格式名)
+    """
+    magic, sample_rate, lip_fps, audio_format = STREAM_HEADER.unpack_from(data)
+    if magic != CLIP_MAGIC:
+        raise ValueError("不是分句音频流")
+    return sample_rate, lip_fps, audio_format.rstrip(b"\0").decode("ascii")
+
+
+def encode_clip(envelope: bytes, audio: bytes, samples: int) -> bytes:
+    return b"".join((FRAME_HEADER.pack(len(envelope), len(audio), samples), envelope, audio))
+
+
+class ClipReader:
+    """
+    从任意切分的字节流中取出完整的帧，不完整的部分留到下一次
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[Tuple[bytes, bytes, int]]:
+        """
+        返回[(口型包络, 音频, 采样点数), ...]
+        """
+        self.buffer += data
+        clips = []
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            envelope_size, audio_size, samples = FRAME_HEADER.unpack_from(self.buffer, offset)
+            start = offset + FRAME_HEADER.size
+            end = start + envelope_size + audio_size
+            if len(self.buffer) < end:
+                break
+            clips.append((bytes(self.buffer[start:start + envelope_size]),
+                          bytes(self.buffer[start + envelope_size:end]), samples))
+            offset = end
+        del self.buffer[:offset]
+        return clips
@@ -1,8 +1,18 @@
+import asyncio
+import hashlib
 import io
+import logging
+import queue
+import re
+import struct
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional
-from fastapi import FastAPI
-from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse
+from typing import Callable, Optional, Union
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import FileResponse, HTMLResponse, Response, StreamingResponse
 # from fastapi_standalone_docs import StandaloneDocs
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
@@ -12,6 +22,13 @@ from tools.server.model_manager import ModelManager
 from fish_speech.utils.schema import ServeReferenceAudio, ServeTTSRequest
 from fish_speech.utils.file import audio_to_bytes, read_ref_text
 import soundfile as sf
+import numpy as np
+
+from tts_cache import TTSCache
+from lip_envelope import analyze_frames, encode_envelope, envelope_header, frame_hop
+from audio_clips import encode_clip, stream_header
+
+logger = logging.getLogger("tts")
 
 # 初始化 FastAPI 应用
 app = FastAPI()
@@ -28,85 +45,580 @@ app.add_middleware(
 
 
 
+def wav_header(sample_rate: int, data_size: int, channels: int = 1, bits_per_sample: int = 16) -> bytes:
+    """
+    44字节的PCM WAV头
+    """
+    byte_rate = sample_rate * channels * bits_per_sample // 8
+    block_align = channels * bits_per_sample // 8
+    riff_size = 0xFFFFFFFF if data_size == 0xFFFFFFFF else 36 + data_size
+    return (b"RIFF" + struct.pack("<I", riff_size) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, byte_rate, block_align, bits_per_sample)
+            + b"data" + struct.pack("<I", data_size))
+
+
+def wav_stream_header(sample_rate: int) -> bytes:
+    """
+    长度未知的流式WAV头（RIFF/data长度填0xFFFFFFFF），后面直接跟PCM数据
+    """
+    return wav_header(sample_rate, 0xFFFFFFFF)
+
+
+def split_stream_text(text: str, min_chars: int = 10) -> list:
+    """
+    按分句标点切分文本，过短的片段与后一段合并，作为流式合成的单位
+    末尾不足一半长度的零碎片段并入前一段，避免单独合成一两个字
+    """
+    pieces = [p for p in re.split(r"(?<=[，,。！？!?；;：:、…~～])", text) if p.strip()]
+    segments = []
+    current = ""
+    for piece in pieces:
+        current += piece
+        if len(current) >= min_chars:
+            segments.append(current)
+            current = ""
+    if current:
+        if segments and len(current) < min_chars // 2:
+            segments[-1] += current
+        else:
+            segments.append(current)
+    return segments or [text]
+
+
+async def submit_first_segment(req: ServeTTSRequest, deadline: Optional[float] = None) -> tuple:
+    """
+    切分流式文本并先合成第一个分句，再开始流式响应：
+    队列已满（503）或排队超时（504）这时还能作为正常的错误响应返回，客户端可以退避重试，
+    而不是收到一个中途断开的200
+    返回(第一个分句的波形, 其余分句的请求)
+    """
+    segment_reqs = [req.model_copy(update={"text": segment, "streaming": False}) for segment in split_stream_text(req.text)]
+    first_audio = await tts_scheduler.submit(segment_reqs[0], deadline=deadline)
+    return first_audio, segment_reqs[1:]
+
+
+async def segment_audios(first_audio: np.ndarray, segment_reqs: list, deadline: Optional[float] = None):
+    """
+    依次产出各分句的波形，每个分句单独提交给调度器，期间其他请求可以插队，不会被一条长句独占
+    """
+    yield first_audio
+    for segment_req in segment_reqs:
+        yield await tts_scheduler.submit(segment_req, deadline=deadline)
+
+
+async def stream_pcm(first_audio: np.ndarray, segment_reqs: list, sample_rate: int,
+                     cache_key: Optional[str] = None, deadline: Optional[float] = None):
+    """
+    逐段合成并产出16bit PCM：先输出WAV头，每合成完一个分句就立即输出，
+    客户端无需等待整句合成完成即可开始播放
+    完整合成后把PCM写入缓存
+    """
+    yield wav_stream_header(sample_rate)
+    pcm_parts = []
+    async for audio in segment_audios(first_audio, segment_reqs, deadline):
+        pcm = to_pcm16(audio)
+        pcm_parts.append(pcm)
+        yield pcm
+    if cache_key is not None:
+        await tts_cache.aput(cache_key, b"".join(pcm_parts))
+
+
+async def stream_clips(first_audio: np.ndarray, segment_reqs: list, sample_rate: int, audio_format: str,
+                       bitrate: Optional[int], cache_key: Optional[str] = None, deadline: Optional[float] = None):
+    """
+    压缩格式的流式输出：与stream_pcm同样逐个分句合成，每个分句单独编码成完整的音频文件，
+    客户端收到一帧就能解码播放；编码和口型分析在线程池中执行
+    分句很短，每帧多出几百字节的容器开销，整体仍比PCM小一个数量级
+    """
+    header = stream_header(sample_rate, LIP_FPS, audio_format)
+    yield header
+    frames = [header]
+    async for audio in segment_audios(first_audio, segment_reqs, deadline):
+        encoded, envelope = await asyncio.to_thread(encode_with_envelope, audio, sample_rate, audio_format, bitrate)
+        frame = encode_clip(envelope, encoded, len(audio))
+        frames.append(frame)
+        yield frame
+    if cache_key is not None:
+        await tts_cache.aput(cache_key, b"".join(frames))
+
+
+@dataclass
+class TTSJob:
+    req: Optional[ServeTTSRequest]
+    key: Optional[str]  # 相同键的请求在同一批内只推理一次
+    future: asyncio.Future
+    loop: asyncio.AbstractEventLoop
+    enqueued_at: float
+    deadline: float
+    started_at: float = field(default=0.0)
+    call: Optional[Callable] = field(default=None)  # 非推理任务，以engine为参数在工作线程中调用
+
+
+class TTSScheduler:
+    """
+    推理调度器：请求进入有界队列，由专门的工作线程按批取出推理，事件循环不再被推理阻塞
+    队列满时直接拒绝（503），排队超过截止时间的请求不再推理（504）
+    fish-speech的自回归解码不支持多条文本同批推理，批内逐条执行，
+    批的作用是合并同一时间窗口内的重复文本，并减少线程切换
+    只有工作线程会访问engine，重载参考音频等操作也要通过run_in_worker排进同一队列
+    """
+    def __init__(self, engine, max_queue: int = 16, max_batch: int = 4, batch_window: float = 0.01,
+                 default_timeout: float = 30.0):
+        self.engine = engine
+        self.queue: "queue.Queue[TTSJob]" = queue.Queue(maxsize=max_queue)
+        self.max_batch = max_batch
+        self.batch_window = batch_window  # 取到第一条后，再等待多久凑批（秒）
+        self.default_timeout = default_timeout  # 默认截止时间（秒），从入队开始计算
+        self.lock = threading.Lock()
+        self.stats = {"submitted": 0, "completed": 0, "rejected": 0, "expired": 0, "cancelled": 0,
+                      "failed": 0, "merged": 0, "batches": 0, "calls": 0}
+        self.queue_waits = deque(maxlen=1000)  # 最近的排队耗时
+        self.latencies = deque(maxlen=1000)  # 最近的端到端耗时（入队到完成）
+        self.busy_seconds = 0.0
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="tts-worker", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _count(self, name: str, n: int = 1):
+        with self.lock:
+            self.stats[name] += n
+
+    async def submit(self, req: ServeTTSRequest, key: Optional[str] = None, deadline: Optional[float] = None) -> np.ndarray:
+        """
+        提交一条合成请求，返回波形；deadline为相对截止时间（秒）
+        """
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        job = TTSJob(req=req, key=key, future=loop.create_future(), loop=loop, enqueued_at=now,
+                     deadline=now + (deadline or self.default_timeout))
+        return await self._enqueue(job)
+
+    async def run_in_worker(self, call: Callable, deadline: Optional[float] = None):
+        """
+        在工作线程中执行call(engine)，与推理串行，避免其他线程并发访问模型和参考音频缓存
+        """
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        job = TTSJob(req=None, key=None, future=loop.create_future(), loop=loop, enqueued_at=now,
+                     deadline=now + (deadline or self.default_timeout), call=call)
+        return await self._enqueue(job)
+
+    async def _enqueue(self, job: TTSJob):
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self._count("rejected")
+            raise HTTPException(status_code=503, detail="TTS队列已满")
+        self._count("submitted")
+        try:
+            return await job.future
+        except TimeoutError:
+            raise HTTPException(status_code=504, detail="TTS排队超时")
+
+    def _collect(self) -> list:
+        """
+        阻塞取出第一条，然后在时间窗口内尽量凑满一批
+        """
+        batch = [self.queue.get()]
+        window_end = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = window_end - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    @staticmethod
+    def _resolve(job: TTSJob, result=None, error: Optional[BaseException] = None):
+        def settle():
+            if job.future.done():  # 调用方已断开
+                return
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+        job.loop.call_soon_threadsafe(settle)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self._count("batches")
+            results = {}  # 键 -> 波形，批内去重
+            for job in batch:
+                now = time.monotonic()
+                if job.future.cancelled():
+                    self._count("cancelled")
+                    continue
+                if now > job.deadline:
+                    self._count("expired")
+                    self._resolve(job, error=TimeoutError())
+                    continue
+                if job.call is not None:
+                    self._count("calls")
+                    try:
+                        self._resolve(job, job.call(self.engine))
+                    except Exception as e:
+                        self._resolve(job, error=e)
+                    continue
+                if job.key is not None and job.key in results:
+                    self._count("merged")
+                    self._resolve(job, results[job.key])
+                    continue
+                job.started_at = now
+                try:
+                    audio = next(inference(job.req, self.engine))
+                except Exception as e:
+                    self._count("failed")
+                    self._resolve(job, error=e)
+                    continue
+                done = time.monotonic()
+                if job.key is not None:
+                    results[job.key] = audio
+                with self.lock:
+                    self.stats["completed"] += 1
+                    self.busy_seconds += done - now
+                    self.queue_waits.append(now - job.enqueued_at)
+                    self.latencies.append(done - job.enqueued_at)
+                self._resolve(job, audio)
+
+    def summary(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+            waits = sorted(self.queue_waits)
+            latencies = sorted(self.latencies)
+            busy = self.busy_seconds
+        elapsed = time.monotonic() - self.started_at
+
+        def percentile(values, q):
+            return round(values[min(len(values) - 1, int(len(values) * q))], 3) if values else None
+
+        stats.update({
+            "queue_depth": self.queue.qsize(),
+            "avg_batch": round((stats["completed"] + stats["merged"]) / stats["batches"], 2) if stats["batches"] else 0.0,
+            "throughput_per_s": round(stats["completed"] / elapsed, 3) if elapsed else 0.0,
+            "utilization": round(busy / elapsed, 3) if elapsed else 0.0,
+            "queue_wait_p50_s": percentile(waits, 0.5),
+            "queue_wait_p95_s": percentile(waits, 0.95),
+            "latency_p50_s": percentile(latencies, 0.5),
+            "latency_p95_s": percentile(latencies, 0.95),
+        })
+        return stats
+
+
+LIP_FPS = 30.0  # 口型包络的帧率
+
+# 格式名 -> (soundfile格式, 子类型, media_type, 编码器支持的采样率)
+AUDIO_FORMATS = {
+    "wav": ("WAV", "PCM_16", "audio/wav", None),
+    "opus": ("OGG", "OPUS", "audio/ogg", (8000, 12000, 16000, 24000, 48000)),
+    "mp3": ("MP3", "MPEG_LAYER_III", "audio/mpeg", (32000, 44100, 48000)),
+}
+
+
+def negotiate_format(requested: Optional[str]) -> str:
+    """
+    客户端请求的格式在本机libsndfile不支持时退回wav
+    """
+    if requested not in AUDIO_FORMATS:
+        return "wav"
+    sf_format, subtype, _, _ = AUDIO_FORMATS[requested]
+    if sf_format in sf.available_formats() and subtype in sf.available_subtypes(sf_format):
+        return requested
+    return "wav"
+
+
+def bitrate_to_compression_level(bitrate: int) -> float:
+    """
+    libsndfile 只接受0~1的压缩等级，这里按6~256kbps线性近似换算
+    """
+    return float(np.clip((256 - bitrate) / (256 - 6), 0.0, 1.0))
+
+
+def resample(audio: np.ndarray, sample_rate: int, target_rate: int) -> np.ndarray:
+    """
+    线性插值重采样，仅用于满足编码器的采样率要求
+    """
+    if sample_rate == target_rate:
+        return audio
+    duration = len(audio) / sample_rate
+    target_times = np.arange(int(duration * target_rate)) / target_rate
+    return np.interp(target_times, np.arange(len(audio)) / sample_rate, audio).astype(np.float32)
+
+
+PCM_BLOCK = 65536  # 分块转换的采样点数，限制临时float缓冲区的大小
+
+
+def to_pcm16(audio: np.ndarray, header: bytes = b"") -> memoryview:
+    """
+    float波形转16bit PCM，写入一块预分配的bytearray，header写在最前面（WAV头等）
+    缩放和限幅按块在一个固定大小的float缓冲区上原地完成，int16直接写进目标缓冲区，
+    整段音频只分配这一块输出，返回其memoryview（Response和b"".join都可直接使用）
+    """
+    out = bytearray(len(header) + len(audio) * 2)
+    out[:len(header)] = header
+    pcm = np.frombuffer(out, dtype="<i2", offset=len(header))
+    scratch = np.empty(min(len(audio), PCM_BLOCK), dtype=np.float32)
+    for start in range(0, len(audio), PCM_BLOCK):
+        block = audio[start:start + PCM_BLOCK]
+        scaled = scratch[:len(block)]
+        np.multiply(block, 32767, out=scaled)
+        np.clip(scaled, -32767, 32767, out=scaled)
+        pcm[start:start + len(block)] = scaled
+    return memoryview(out)
+
+
+def encode_audio(audio: np.ndarray, sample_rate: int, audio_format: str, bitrate: Optional[int]) -> Union[bytes, memoryview]:
+    """
+    将波形编码为指定格式（CPU密集，在线程池中调用）
+    WAV不经过soundfile，头和PCM写进同一块缓冲区
+    """
+    if audio_format == "wav":
+        return to_pcm16(audio, wav_header(sample_rate, len(audio) * 2))
+    sf_format, subtype, _, sample_rates = AUDIO_FORMATS[audio_format]
+    if sample_rates and sample_rate not in sample_rates:
+        target_rate = min((r for r in sample_rates if r >= sample_rate), default=sample_rates[-1])
+        audio = resample(audio, sample_rate, target_rate)
+        sample_rate = target_rate
+    kwargs = {}
+    if audio_format != "wav" and bitrate:
+        kwargs["compression_level"] = bitrate_to_compression_level(bitrate)
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, sample_rate, format=sf_format, subtype=subtype, **kwargs)
+    return buffer.getvalue()
+
+
+def encode_with_envelope(audio: np.ndarray, sample_rate: int, audio_format: str, bitrate: Optional[int]) -> tuple:
+    """
+    编码音频的同时计算口型包络（在线程池中调用），包络基于编码前的原始波形
+    """
+    volume, viseme = analyze_frames(audio, sample_rate, LIP_FPS)
+    return encode_audio(audio, sample_rate, audio_format, bitrate), encode_envelope(volume, viseme)
+
+
+def lip_headers(envelope: bytes, sample_rate: int) -> dict:
+    return {"X-Lip-Envelope": envelope_header(envelope), "X-Lip-Fps": str(sample_rate / frame_hop(sample_rate, LIP_FPS))}
+
+
+class DebugRecorder:
+    """
+    调试用：按比例抽样保存合成结果，写盘放到线程池，目录内只保留最新的若干个文件
+    sample_ratio为0时不保存
+    """
+    def __init__(self, directory: str = "debug_audio", sample_ratio: float = 0.0,
+                 max_files: int = 20, max_file_bytes: int = 4 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.sample_ratio = sample_ratio
+        self.max_files = max_files
+        self.max_file_bytes = max_file_bytes  # 超过该大小的结果不保存
+        self.counter = 0
+        self.tasks = set()  # 保持写盘任务的引用，避免被回收
+
+    def record(self, data: bytes, audio_format: str):
+        """
+        不等待写盘完成，调用开销只有一次计数
+        """
+        if self.sample_ratio <= 0 or len(data) > self.max_file_bytes:
+            return
+        self.counter += 1
+        if self.counter % max(1, round(1 / self.sample_ratio)):
+            return
+        task = asyncio.create_task(asyncio.to_thread(self._write, data, f"{self.counter:08d}.{audio_format}"))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def _write(self, data: bytes, name: str):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        (self.directory / name).write_bytes(data)
+        files = sorted(self.directory.iterdir(), key=lambda p: p.stat().st_mtime)
+        for stale in files[:-self.max_files]:
+            stale.unlink(missing_ok=True)
+
+
+# 内置角色：名称 -> [(参考音频路径, 参考文本)]
+BUILTIN_CHARACTERS = {
+    "wx": [
+        ("data/wx.wav", "路基智能设计子系统：以数据为核心，模型为承载，实现了支挡结构、排水工程、边坡防护、基床填挖方及地基处理的参数化设计和模型联动更新。软件已成功应用于长沙至浏阳市域(郊)铁路、台州市域S2线，深汕铁路的BIM建模项目。相比于Revit、Bently的传统方法，本系统提高了路基三维设计效率约10倍以上。"),
+    ],
+    "dz": [
+        ("data/阿爸阿妈已经把中午饭准备好了。.mp3", "阿爸阿妈已经把中午饭准备好了。"),
+        ("data/讲我和动物朋友们的故事。.mp3", "讲我和动物朋友们的故事。"),
+        ("data/在山里我能听到各种各样的叫声。.mp3", "在山里我能听到各种各样的叫声。"),
+        ("data/这是礼堂的环保。.mp3", "这是礼堂的环保。"),
+        ("data/这是猞猁。.mp3", "这是猞猁。"),
+    ],
+    "1": [
+        ("data/1_1.mp3", "Hello, how are you? 这是一段测试文本。こんにちは、お元気ですか？。今天的日期是2025年1月7日。有些鸟儿注定是关不住的，它们的每一片羽毛上，都闪烁的自由的光辉！"),
+    ],
+}
+
+AUDIO_EXTENSIONS = {".wav", ".mp3", ".flac", ".ogg"}
+
+
+class CharacterRegistry:
+    """
+    角色参考音频注册表：启动或重载时一次性读取参考音频并预先编码，
+    请求时直接复用，不再有逐请求的文件读取和参考音频编码
+    新角色放在 data/<角色名>/ 下，参考文本取同名 .lab/.txt 文件，没有时取文件名
+    """
+    def __init__(self, data_dir: str = "data", builtin: Optional[dict] = None):
+        self.data_dir = Path(data_dir)
+        self.builtin = builtin or {}
+        self.characters = {}  # 名称 -> {"references": [...], "fingerprint": str}
+
+    def scan(self) -> dict:
+        """
+        内置角色加上 data/ 下每个子目录一个角色
+        """
+        found = {name: list(items) for name, items in self.builtin.items()}
+        if not self.data_dir.is_dir():
+            return found
+        for folder in sorted(p for p in self.data_dir.iterdir() if p.is_dir()):
+            items = []
+            for audio_path in sorted(folder.iterdir()):
+                if audio_path.suffix.lower() not in AUDIO_EXTENSIONS:
+                    continue
+                text = audio_path.stem
+                for suffix in (".lab", ".txt"):
+                    text_path = audio_path.with_suffix(suffix)
+                    if text_path.exists():
+                        text = text_path.read_text(encoding="utf-8").strip()
+                        break
+                items.append((str(audio_path), text))
+            if items:
+                found[folder.name] = items
+        return found
+
+    def load(self, engine) -> list:
+        """
+        读取并编码全部角色的参考音频，完成后整体替换，重载期间的请求仍使用旧数据
+        """
+        characters = {}
+        for name, items in self.scan().items():
+            references = []
+            digest = hashlib.sha256()
+            for audio_path, text in items:
+                audio = audio_to_bytes(audio_path)
+                if audio is None:
+                    logger.warning(f"参考音频读取失败: {audio_path}")
+                    continue
+                references.append(ServeReferenceAudio(audio=audio, text=text))
+                digest.update(audio)
+                digest.update(text.encode("utf-8"))
+            if not references:
+                continue
+            # 预先完成参考音频的VQ编码，结果进入推理引擎按哈希索引的内存缓存
+            engine.load_by_hash(references, "on")
+            characters[name] = {"references": references, "fingerprint": digest.hexdigest()}
+        self.characters = characters
+        return sorted(characters)
+
+    def get(self, name: str) -> Optional[dict]:
+        return self.characters.get(name)
+
+
+# 影响合成结果的采样参数，同时参与缓存键的计算
+SAMPLING_PARAMS = {
+    "chunk_length": 200,
+    "max_new_tokens": 1024,
+    "top_p": 0.7,
+    "repetition_penalty": 1.2,
+    "temperature": 0.7,
+    "seed": None,
+}
+
+
 class TTSRequest(BaseModel):
     text: str
     streaming: bool = False
     character: Optional[str] = None
+    format: str = "wav"  # wav / opus / mp3，不支持时退回wav，实际格式见响应的Content-Type
+    bitrate: Optional[int] = None  # 压缩格式的目标码率（kbps）
+    deadline: Optional[float] = None  # 排队截止时间（秒），超时返回504，不填使用调度器默认值
 # 定义请求模型
 @app.post("/tts/")
 async def tts(req: TTSRequest):
     # Perform TTS
     engine = model_manager.tts_inference_engine
+    # 流式请求wav时输出PCM，请求压缩格式时逐个分句编码下发
+    audio_format = negotiate_format(req.format)
+    bitrate = req.bitrate
+    sample_rate = engine.decoder_model.spec_transform.sample_rate
 
-    if req.character == None:
-        references=[]
+    # 参考音频在启动/重载时已读取并编码，这里只取引用
+    if req.character is None:
+        references = []
+        voice = None
     else:
-        
-        if req.character == "wx":
-            ref_texts = ["路基智能设计子系统：以数据为核心，模型为承载，实现了支挡结构、排水工程、边坡防护、基床填挖方及地基处理的参数化设计和模型联动更新。软件已成功应用于长沙至浏阳市域(郊)铁路、台州市域S2线，深汕铁路的BIM建模项目。相比于Revit、Bently的传统方法，本系统提高了路基三维设计效率约10倍以上。"]
-            ref_audios = ["data/wx.wav"]
-        if req.character == "dz":
-            ref_texts = ["阿爸阿妈已经把中午饭准备好了。",
-                        "讲我和动物朋友们的故事。",
-                        "在山里我能听到各种各样的叫声。",
-                        "这是礼堂的环保。",
-                        "这是猞猁。"
-                        ]
-            ref_audios = ["data/阿爸阿妈已经把中午饭准备好了。.mp3",
-                        "data/讲我和动物朋友们的故事。.mp3",
-                        "data/在山里我能听到各种各样的叫声。.mp3",
-                        "data/这是礼堂的环保。.mp3",
-                        "data/这是猞猁。.mp3"
-                        ]
-        if req.character == "1":
-            ref_texts = ["Hello, how are you? 这是一段测试文本。こんにちは、お元気ですか？。今天的日期是2025年1月7日。有些鸟儿注定是关不住的，它们的每一片羽毛上，都闪烁的自由的光辉！"
-                        ]
-            ref_audios = ["data/1_1.mp3"]
-
-        byte_audios = [audio_to_bytes(ref_audio) for ref_audio in ref_audios]
-        # print(byte_audios)
-        references = [
-                ServeReferenceAudio(
-                    audio=ref_audio if ref_audio is not None else b"", text=ref_text
-                )
-                for ref_text, ref_audio in zip(ref_texts, byte_audios)
-            ]
-    # print(references)
+        character = character_registry.get(req.character)
+        if character is None:
+            raise HTTPException(status_code=404, detail=f"未知角色: {req.character}")
+        references = character["references"]
+        voice = character["fingerprint"]
 
+    # 流式PCM缓存的是不带头的PCM，流式压缩格式缓存的是整个分句流，整句缓存的是编码后的完整文件
+    # 键中使用参考音频的指纹而不是角色名，替换参考音频后旧缓存自动失效
+    cache_key = tts_cache.make_key(
+        req.text,
+        voice=voice,
+        format=("pcm" if audio_format == "wav" else f"{audio_format}-clips") if req.streaming else audio_format,
+        bitrate=bitrate,
+        **SAMPLING_PARAMS,
+    )
+    cached = await tts_cache.aget(cache_key)
+    if cached is not None:
+        if req.streaming and audio_format == "wav":
+            return StreamingResponse(iter([wav_stream_header(sample_rate), cached]), media_type="audio/wav")
+        if req.streaming:
+            return StreamingResponse(iter([cached]), media_type="application/octet-stream",
+                                     headers={"X-Audio-Format": audio_format, "X-Cache": "hit"})
+        headers = {"X-Audio-Format": audio_format, "X-Cache": "hit"}
+        envelope = await tts_cache.aget(cache_key + "-lip")
+        if envelope is not None:
+            headers.update(lip_headers(envelope, sample_rate))
+        return Response(content=cached, media_type=AUDIO_FORMATS[audio_format][2], headers=headers)
+
+    deadline = req.deadline
     req = ServeTTSRequest(
         text=req.text,
-        chunk_length= 200,
         format="wav",
         references=references,
         reference_id = None,
-        seed=None,
         use_memory_cache="on",
         normalize=True,
         streaming=req.streaming,
-        max_new_tokens=1024,
-        top_p=0.7,
-        repetition_penalty=1.2,
-        temperature=0.7
+        **SAMPLING_PARAMS,
     )
 
-    fake_audios = next(inference(req, engine))
-    buffer = io.BytesIO()
-    sf.write(
-        buffer,
+    if req.streaming:
+        # 第一个分句在响应开始前合成，503/504能以正常的状态码返回
+        first_audio, segment_reqs = await submit_first_segment(req, deadline)
+        if audio_format == "wav":
+            return StreamingResponse(stream_pcm(first_audio, segment_reqs, sample_rate, cache_key, deadline),
+                                     media_type="audio/wav")
+        return StreamingResponse(stream_clips(first_audio, segment_reqs, sample_rate, audio_format, bitrate, cache_key, deadline),
+                                 media_type="application/octet-stream", headers={"X-Audio-Format": audio_format})
+
+    # 推理在调度器的工作线程中执行
+    fake_audios = await tts_scheduler.submit(req, key=cache_key, deadline=deadline)
+    # 编码放到线程池中，避免压缩时阻塞事件循环
+    audio_data, envelope = await asyncio.to_thread(
+        encode_with_envelope,
         fake_audios,
-        engine.decoder_model.spec_transform.sample_rate,
-        format=req.format,
+        sample_rate,
+        audio_format,
+        bitrate,
     )
+    # 缓存、调试抽样和响应共用同一块缓冲区，不再复制；口型包络单独缓存
+    await tts_cache.aput(cache_key, audio_data)
+    await tts_cache.aput(cache_key + "-lip", envelope)
+    debug_recorder.record(audio_data, audio_format)
 
-    # 设置文件指针的位置为文件的开始，确保响应时能够从头开始读取
-    buffer.seek(0)
-
-    # 保存生成的音频文件
-    with open(f"audio.{req.format}", "wb") as f:
-        f.write(buffer.getvalue())
-
-    # 返回生成的音频文件
-    return StreamingResponse(buffer, media_type="audio/wav")
+    headers = {"X-Audio-Format": audio_format}
+    headers.update(lip_headers(envelope, sample_rate))
+    return Response(content=audio_data, media_type=AUDIO_FORMATS[audio_format][2], headers=headers)
 
     # return StreamResponse(
     #     iterable=buffer_to_async_generator(buffer.getvalue()),
@@ -116,7 +628,49 @@ async def tts(req: TTSRequest):
     #     content_type=get_content_type(req.format),
     # )
 
+@app.get("/characters/")
+async def list_characters():
+    """
+    已加载的角色及其参考音频数量
+    """
+    return {name: len(c["references"]) for name, c in character_registry.characters.items()}
+
+
+@app.post("/characters/reload/")
+async def reload_characters():
+    """
+    重新扫描 data/ 并预编码参考音频，新增角色无需重启服务
+    预编码要使用推理引擎，交给调度器的工作线程执行，与正在进行的合成串行
+    """
+    names = await tts_scheduler.run_in_worker(character_registry.load)
+    logger.info(f"已重载角色: {names}")
+    return {"characters": names}
+
+
+@app.get("/scheduler_stats/")
+async def scheduler_stats():
+    """
+    推理调度器的排队、吞吐和延迟统计
+    """
+    return tts_scheduler.summary()
+
+
+@app.get("/cache_stats/")
+async def cache_stats():
+    """
+    TTS缓存命中率等统计
+    """
+    return tts_cache.summary()
+
+
 if __name__ == "__main__":
+    logger.setLevel(logging.INFO)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(console_handler)
+
+    # 内存层256MB，磁盘层挂载到容器外，重启后仍然有效
+    tts_cache = TTSCache(max_bytes=256 * 1024 * 1024, disk_dir="audio_cache", disk_max_bytes=4 * 1024 * 1024 * 1024)
     model_manager = ModelManager(
             mode="tts",
             device="cuda",
@@ -127,4 +681,12 @@ if __name__ == "__main__":
             decoder_checkpoint_path="checkpoints/fish-speech-1.5/firefly-gan-vq-fsq-8x1024-21hz-generator.pth",
             decoder_config_name="firefly_gan_vq",
         )
+    character_registry = CharacterRegistry(data_dir="data", builtin=BUILTIN_CHARACTERS)
+    # 此时工作线程尚未启动，可以直接使用engine
+    logger.info(f"已加载角色: {character_registry.load(model_manager.tts_inference_engine)}")
+    # 调试时把sample_ratio调大即可抽样保存合成结果
+    debug_recorder = DebugRecorder(directory="debug_audio", sample_ratio=0.0, max_files=20)
+    # 单GPU单工作线程，队列上限决定最多积压多少句
+    tts_scheduler = TTSScheduler(model_manager.tts_inference_engine, max_queue=16, max_batch=4, batch_window=0.01)
+    tts_scheduler.start()
     uvicorn.run(app, host="0.0.0.0", port=7860)
\ No newline at end of file
@@ -0,0 +1,99 @@
+# lip_envelope.py
+# 口型包络：按固定帧率从PCM计算每帧的音量和口型，客户端只需按时间插值，不再各自实时分析音频
+# fish_speech服务和app3d共用
+
+import base64
+from typing import Optional, Tuple
+
+import numpy as np
+
+# 口型编号，与客户端 VRMExpressionPresetName 一致
+VISEMES = ["aa", "ou", "oh", "ee"]
+LOW_BAND, MID_BAND, HIGH_BAND = (100, 400), (400, 1600), (1600, 5000)
+
+
+def frame_hop(sample_rate: int, fps: float = 30.0) -> int:
+    return max(1, round(sample_rate / fps))
+
+
+def analyze_frames(audio: np.ndarray, sample_rate: int, fps: float = 30.0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    计算整帧部分的(音量, 口型)，都为uint8数组，不足一帧的尾部忽略
+    音量沿用客户端的算法：帧内峰值经sigmoid映射，低于0.1视为闭嘴
+    口型按低/中/高频带的平均能量（dB）比较得出
+    """
+    if audio.dtype == np.int16:
+        audio = audio.astype(np.float32) / 32768
+    hop = frame_hop(sample_rate, fps)
+    count = len(audio) // hop
+    if count == 0:
+        return np.zeros(0, np.uint8), np.zeros(0, np.uint8)
+    frames = audio[:count * hop].reshape(count, hop)
+
+    peak = np.abs(frames).max(axis=1)
+    volume = 1 / (1 + np.exp(-45 * peak + 5))
+    volume[volume < 0.1] = 0
+    volume = np.round(volume * 255).astype(np.uint8)
+
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(hop), axis=1)) ** 2
+    db = 10 * np.log10(spectrum + 1e-12)
+    freqs = np.fft.rfftfreq(hop, 1 / sample_rate)
+
+    def band(low_high):
+        mask = (freqs >= low_high[0]) & (freqs <= low_high[1])
+        return db[:, mask].mean(axis=1) if mask.any() else np.full(count, -np.inf)
+
+    low, mid, high = band(LOW_BAND), band(MID_BAND), band(HIGH_BAND)
+    viseme = np.full(count, VISEMES.index("ou"), np.uint8)
+    low_max = (low >= mid) & (low >= high)
+    viseme[low_max & (mid > low - 5)] = VISEMES.index("aa")
+    viseme[~low_max & (mid >= high)] = VISEMES.index("oh")
+    viseme[~low_max & (high > mid)] = VISEMES.index("ee")
+    return volume, viseme
+
+
+def lip_meta(volume: np.ndarray, viseme: np.ndarray, sample_rate: int, fps: float = 30.0) -> dict:
+    """
+    随音频一起下发的口型数据，fps为按整数帧长换算后的实际帧率
+    """
+    return {
+        "fps": sample_rate / frame_hop(sample_rate, fps),
+        "volume": volume.tolist(),
+        "viseme": viseme.tolist(),
+    }
+
+
+def encode_envelope(volume: np.ndarray, viseme: np.ndarray) -> bytes:
+    """
+    紧凑编码：音量字节后接口型字节，两段等长
+    """
+    return volume.tobytes() + viseme.tobytes()
+
+
+def decode_envelope(data: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    half = len(data) // 2
+    return np.frombuffer(data[:half], np.uint8), np.frombuffer(data[half:half * 2], np.uint8)
+
+
+def envelope_header(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+class EnvelopeTracker:
+    """
+    流式PCM的增量分析：不足一帧的样本留到下一个分片，保证帧边界与整段分析一致
+    """
+    def __init__(self, sample_rate: int, fps: float = 30.0):
+        self.sample_rate = sample_rate
+        self.fps = fps
+        self.hop = frame_hop(sample_rate, fps)
+        self.carry: Optional[np.ndarray] = None
+
+    def feed(self, pcm: bytes) -> dict:
+        samples = np.frombuffer(pcm, dtype="<i2", count=len(pcm) // 2)
+        if self.carry is not None and len(self.carry):
+            samples = np.concatenate((self.carry, samples))
+        count = len(samples) // self.hop
+        self.carry = samples[count * self.hop:].copy()
+        volume, viseme = analyze_frames(samples[:count * self.hop], self.sample_rate, self.fps)
+        return lip_meta(volume, viseme, self.sample_rate, self.fps)
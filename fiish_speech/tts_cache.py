@@ -0,0 +1,180 @@
+# tts_cache.py
+# 按内容寻址的TTS音频缓存：内存LRU（按字节数限制）+ 可选的磁盘层（每条一个文件，重启后仍可命中）
+# fish_speech服务和app3d共用
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+
+class TTSCache:
+    """
+    TTS结果缓存，键由归一化文本、角色、采样参数和随机种子计算
+    同步接口线程安全，可在线程池中调用；异步接口把磁盘读写放到线程池，不阻塞事件循环
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes  # 内存层的字节上限
+        self.disk_dir = disk_dir  # 磁盘层目录，None表示不启用
+        self.disk_max_bytes = disk_max_bytes  # 磁盘层的字节上限
+        self.memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_index: "OrderedDict[str, int]" = OrderedDict()  # 键 -> 文件大小，按最近使用排序
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "puts": 0, "evictions": 0}
+        if disk_dir:
+            self._load_disk_index()
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """
+        全半角统一、去掉首尾空白、合并连续空白
+        """
+        return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+    @classmethod
+    def make_key(cls, text: str, **params) -> str:
+        """
+        计算缓存键，params包含角色、采样参数、随机种子、输出格式等一切影响音频的参数
+        """
+        material = json.dumps({"text": cls.normalize_text(text), **params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.bin")
+
+    def _load_disk_index(self):
+        """
+        启动时扫描磁盘层，按修改时间恢复LRU顺序
+        """
+        entries = []
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if name.endswith(".bin"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.disk_index[key] = size
+            self.disk_bytes += size
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        先查内存，再查磁盘；磁盘命中的条目会提升到内存
+        """
+        data = self.get_memory(key)
+        if data is not None:
+            return data
+        return self.get_disk(key)
+
+    def get_memory(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+            elif not self.disk_dir:
+                self.stats["misses"] += 1
+            return data
+
+    def get_disk(self, key: str) -> Optional[bytes]:
+        if not self.disk_dir:
+            return None
+        with self.lock:
+            if key not in self.disk_index:
+                self.stats["misses"] += 1
+                return None
+            self.disk_index.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self.lock:
+                self.disk_bytes -= self.disk_index.pop(key, 0)
+                self.stats["misses"] += 1
+            return None
+        with self.lock:
+            self.stats["disk_hits"] += 1
+        self._put_memory(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        with self.lock:
+            self.stats["puts"] += 1
+        self._put_memory(key, data)
+        self._put_disk(key, data)
+
+    def _put_memory(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= len(self.memory.pop(key))
+            self.memory[key] = data
+            self.memory_bytes += len(data)
+            while self.memory_bytes > self.max_bytes:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+                self.stats["evictions"] += 1
+
+    def _put_disk(self, key: str, data: bytes):
+        if not self.disk_dir or len(data) > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再原子替换，进程中途退出也不会留下半个条目
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        stale = []
+        with self.lock:
+            self.disk_bytes -= self.disk_index.pop(key, 0)
+            self.disk_index[key] = len(data)
+            self.disk_bytes += len(data)
+            while self.disk_bytes > self.disk_max_bytes:
+                evicted_key, size = self.disk_index.popitem(last=False)
+                self.disk_bytes -= size
+                stale.append(evicted_key)
+        for evicted_key in stale:
+            try:
+                os.remove(self._path(evicted_key))
+            except OSError:
+                pass
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        """
+        内存命中直接返回，磁盘读取放到线程池
+        """
+        data = self.get_memory(key)
+        if data is not None or not self.disk_dir:
+            return data
+        return await asyncio.to_thread(self.get_disk, key)
+
+    async def aput(self, key: str, data: bytes):
+        with self.lock:
+            self.stats["puts"] += 1
+        self._put_memory(key, data)
+        if self.disk_dir:
+            await asyncio.to_thread(self._put_disk, key, data)
+
+    def summary(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update({
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_entries": len(self.disk_index),
+                "disk_bytes": self.disk_bytes,
+            })
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
@@ -1,36 +1,154 @@
 import asyncio
-from logging import getLogger
+import codecs
 import json
-import base64
+import os
 import re
+import tempfile
+from collections import deque
+from logging import getLogger
+from typing import Callable, Iterator, Optional, Tuple
 
 logger = getLogger('llm')
 
-async def read_ebook(main_queue: asyncio.Queue, main_task_queue: asyncio.Queue):
+BOOKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "books")
+
+# 句末标点（含后面的引号括号）或空行，作为段落的切分点
+SENTENCE_END = re.compile(r"[。！？!?…]+[”’」』）)\"']*|\n\s*\n")
+
+
+class BookReader:
     """
-    读取电子书并处理
+    流式读取一本书：按行惰性读取，内存只保留当前段落，
+    在目标长度之后的第一个句末切段，每段都附带其结束位置的字节偏移，用作书签
+    """
+    def __init__(self, path: str, offset: int = 0, target_chars: int = 100, max_chars: int = 300):
+        self.path = path
+        self.offset = offset  # 从该字节偏移开始读（续读）
+        self.target_chars = target_chars
+        self.max_chars = max_chars  # 一直没有句末标点时的强制切分长度
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        去掉每行首尾空白和空行，保留换行
+        """
+        return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+    def _cut(self, text: str) -> Optional[int]:
+        if len(text) < self.target_chars:
+            return None
+        match = SENTENCE_END.search(text, self.target_chars)
+        if match:
+            return match.end()
+        return self.max_chars if len(text) >= self.max_chars else None
+
+    def paragraphs(self) -> Iterator[Tuple[str, int]]:
+        """
+        逐段产出(段落文本, 段落结束的字节偏移)，文件末尾不足目标长度的部分也会产出
+        保留原始字节（含换行、非法编码），偏移可以精确换算
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="surrogateescape")
+        buffer = ""
+        start = self.offset  # buffer开头对应的字节偏移
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            while True:
+                line = f.readline(65536)
+                buffer += decoder.decode(line, final=not line)
+                while True:
+                    cut = self._cut(buffer)
+                    if cut is None:
+                        break
+                    raw, buffer = buffer[:cut], buffer[cut:]
+                    start += len(raw.encode("utf-8", errors="surrogateescape"))
+                    text = self.normalize(raw)
+                    if text:
+                        yield text, start
+                if not line:
+                    break
+        text = self.normalize(buffer)
+        if text:
+            yield text, start + len(buffer.encode("utf-8", errors="surrogateescape"))
+
+
+class BookmarkStore:
+    """
+    每本书的已读字节偏移，保存在json文件中，重启后从书签处续读
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.bookmarks = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.bookmarks = json.load(f)
+
+    def get(self, book: str) -> dict:
+        return self.bookmarks.get(book, {"offset": 0, "finished": False})
+
+    def _write(self, data: str):
+        # 先写临时文件再替换，中途退出不会损坏书签
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    async def save(self, book: str, offset: int, finished: bool = False):
+        self.bookmarks[book] = {"offset": offset, "finished": finished}
+        await asyncio.to_thread(self._write, json.dumps(self.bookmarks, ensure_ascii=False, indent=2))
+
+
+def pending_books(books_dir: str, bookmarks: BookmarkStore) -> list:
+    """
+    目录下按文件名排序的未读完的书，即朗读队列；目录不存在时返回空列表，等下次重新扫描
+    """
+    try:
+        names = sorted(name for name in os.listdir(books_dir) if name.endswith(".txt"))
+    except FileNotFoundError:
+        logger.warning(f"电子书目录不存在: {books_dir}")
+        return []
+    return [name for name in names if not bookmarks.get(name)["finished"]]
+
+
+async def read_ebook(main_queue: asyncio.Queue, main_task_queue: asyncio.Queue,
+                     books_dir: str = BOOKS_DIR, bookmark_path: Optional[str] = None,
+                     target_chars: int = 100, rescan_interval: float = 60.0,
+                     lookahead: int = 0, prefetch: Optional[Callable[[str], None]] = None):
+    """
+    读取电子书并处理：按目录顺序逐本朗读，每读完一段更新书签
+    lookahead大于0时，当前段落读完前就提前发出后面的若干段，并交给prefetch提前合成
+    全部读完后定期检查目录中有没有新书
     """
     await asyncio.sleep(5)
     logger.info("读书模块启动成功")
-    
-    with open("/root/prj/cyber_npc/play_tools/read_ebook/books/test.txt", "r", encoding="utf-8") as f:
-        lines = f.readlines()
-        
-        sentence = ""
-        for line in lines:
-            line = line.strip()
-            if len(sentence)>100:
-                logger.info(f"读书模块读取到句子: {sentence}")
-                await main_queue.put({
-                    "type": "ebook",
-                    "text": f"\"\"\"\n{sentence}\n\"\"\"",
-                })
-                logger.info(f"读书模块发送消息: \"\"\"\n{sentence}\n\"\"\"")
-                sentence = ""
+    bookmarks = BookmarkStore(bookmark_path or os.path.join(books_dir, "bookmarks.json"))
+
+    while True:
+        books = pending_books(books_dir, bookmarks)
+        if not books:
+            await asyncio.sleep(rescan_interval)
+            continue
+        book = books[0]
+        bookmark = bookmarks.get(book)
+        logger.info(f"开始阅读《{book}》，从第{bookmark['offset']}字节处继续")
+        reader = BookReader(os.path.join(books_dir, book), offset=bookmark["offset"], target_chars=target_chars)
+        offset = bookmark["offset"]
+        in_flight = deque()  # 已发出、尚未读完的段落的结束偏移，按顺序确认
+        for sentence, offset in reader.paragraphs():
+            logger.info(f"读书模块读取到句子: {sentence}")
+            await main_queue.put({
+                "type": "ebook",
+                "text": sentence,
+            })
+            # 马上就要读的段落不用预合成
+            if prefetch is not None and in_flight:
+                prefetch(sentence)
+            in_flight.append(offset)
+            if len(in_flight) > lookahead:
                 await main_task_queue.get()
+                await bookmarks.save(book, in_flight.popleft())
                 logger.info(f"开始阅读下一段")
-            else:
-                sentence += line + "\n"
-                
-
-        # logger.info(f"text_audio消息已完成播放: {sentence}")
\ No newline at end of file
+        while in_flight:
+            await main_task_queue.get()
+            await bookmarks.save(book, in_flight.popleft())
+        await bookmarks.save(book, offset, finished=True)
+        logger.info(f"《{book}》已读完")
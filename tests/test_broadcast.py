@@ -0,0 +1,106 @@
+# test_broadcast.py
+# 数十个模拟WebSocket客户端（其中一个故意很慢）：广播不被慢客户端拖住，
+# 快客户端收到每一帧，慢客户端被断开，丢弃和断开都有计数
+
+import asyncio
+import json
+import logging
+import os
+import struct
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app3d  # noqa: E402
+
+FAST_CLIENTS = 32
+FRAMES = 40
+MAX_QUEUE = 8
+MAX_LAG = 0.2
+
+
+class FakeWebSocket:
+    """
+    只实现ConnectionManager用到的接口，记录收到的每条消息的帧序号
+    """
+    def __init__(self, name: str, send_delay: float = 0.0):
+        self.client = name
+        self.send_delay = send_delay
+        self.received = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def _send(self, meta: dict):
+        if self.closed:
+            raise RuntimeError("websocket已关闭")
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        self.received.append(meta["i"])
+
+    async def send_text(self, message: str):
+        await self._send(json.loads(message))
+
+    async def send_bytes(self, message: bytes):
+        size = struct.unpack_from(">I", message)[0]
+        await self._send(json.loads(message[4:4 + size]))
+
+    async def close(self):
+        self.closed = True
+
+
+async def run_scenario() -> tuple:
+    manager = app3d.ConnectionManager(max_queue=MAX_QUEUE, max_lag=MAX_LAG)
+    fast = [FakeWebSocket(f"fast-{i}") for i in range(FAST_CLIENTS)]
+    slow = FakeWebSocket("slow", send_delay=1.0)
+    for i, websocket in enumerate(fast + [slow]):
+        await manager.connect(websocket, binary=i % 2 == 0)
+
+    payload = os.urandom(16384)
+    broadcast_times = []
+    for i in range(FRAMES):
+        start = time.perf_counter()
+        await manager.broadcast_frame({"type": "audio_chunk", "i": i}, payload)
+        broadcast_times.append(time.perf_counter() - start)
+        await asyncio.sleep(0.005)
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and (any(len(w.received) < FRAMES for w in fast) or not slow.closed):
+        await asyncio.sleep(0.01)
+    return manager, fast, slow, broadcast_times
+
+
+@pytest.fixture(scope="module")
+def scenario():
+    app3d.logger = logging.getLogger("llm")
+    return asyncio.run(run_scenario())
+
+
+def test_fast_clients_receive_every_frame_in_order(scenario):
+    _, fast, _, _ = scenario
+    for websocket in fast:
+        assert websocket.received == list(range(FRAMES)), websocket.client
+
+
+def test_slow_client_is_disconnected(scenario):
+    manager, _, slow, _ = scenario
+    assert slow.closed
+    assert slow not in manager.active_connections
+    assert len(slow.received) < FRAMES
+
+
+def test_drops_and_disconnects_are_counted(scenario):
+    manager, _, _, _ = scenario
+    # 慢客户端的队列只能缓存MAX_QUEUE条，断开前的其余帧被丢弃；快客户端不丢
+    assert manager.dropped_messages > 0
+    assert manager.slow_disconnects == 1
+
+
+def test_broadcast_does_not_wait_for_clients(scenario):
+    _, _, _, broadcast_times = scenario
+    # 广播只是入队，不随慢客户端的发送耗时（1秒）增长
+    assert max(broadcast_times) < 0.05
@@ -0,0 +1,54 @@
+# test_emotion.py
+# 本地情感分类器：否定词、缓存与词典线索冲突时的处理
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app3d import EmotionTagger, LexiconEmotionClassifier, NearestNeighbourEmotionClassifier  # noqa: E402
+
+THRESHOLD = 0.6
+
+
+@pytest.fixture
+def tagger():
+    return EmotionTagger(classifiers=[LexiconEmotionClassifier(), NearestNeighbourEmotionClassifier()],
+                         threshold=THRESHOLD)
+
+
+@pytest.mark.parametrize("sentence", ["我今天不开心", "我一点都不喜欢你", "我不是很高兴", "没有生气啦"])
+def test_negated_keyword_escalates(sentence):
+    assert LexiconEmotionClassifier().classify(sentence)[1] < THRESHOLD
+
+
+@pytest.mark.parametrize("sentence, expected", [("我今天很开心", "happy"), ("哈哈哈太好了！", "happy"),
+                                                ("呜呜好伤心", "sad")])
+def test_clear_cue_is_accepted_locally(sentence, expected):
+    emotion, confidence = LexiconEmotionClassifier().classify(sentence)
+    assert emotion == expected
+    assert confidence >= THRESHOLD
+
+
+def test_no_cue_sentence_escalates():
+    assert LexiconEmotionClassifier().classify("今天天气不错。")[1] < THRESHOLD
+
+
+def test_cache_does_not_override_lexicon_cue(tagger):
+    tagger.learn("谢谢大家今天来看我的直播我真的很开心", "happy")
+    emotion, confidence, _ = tagger.classify_local("谢谢大家今天来看我的直播我真的很难过")
+    assert emotion != "happy"
+    assert confidence < THRESHOLD
+
+
+def test_cache_answers_no_cue_repeats(tagger):
+    tagger.learn("今天我们来读一本书", "relaxed")
+    assert tagger.classify_local("今天我们来读一本书。") == ("relaxed", 1.0, "cache")
+
+
+def test_cache_requires_high_similarity():
+    cache = NearestNeighbourEmotionClassifier(min_similarity=0.9)
+    cache.learn("谢谢大家今天来看我的直播我真的很开心", "happy")
+    assert cache.classify("谢谢大家今天来看我的直播我真的很难过") == ("neutral", 0.0)
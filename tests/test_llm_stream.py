@@ -0,0 +1,84 @@
+# test_llm_stream.py
+# llm流式输出不阻塞事件循环：模拟服务与心跳任务跑在同一个事件循环里，
+# 流式生成期间心跳的调度延迟必须保持在阈值以内
+
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import openai
+import pytest
+import uvicorn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmark"))
+
+import app3d  # noqa: E402
+from fake_openai_server import DEFAULT_REPLY, create_app  # noqa: E402
+
+HEARTBEAT_INTERVAL = 0.01
+MAX_LAG = 0.1  # 同步客户端会让心跳停摆整段回复（约2秒），远超这个阈值
+
+
+async def heartbeat(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        expected = time.perf_counter() + HEARTBEAT_INTERVAL
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        lags.append(time.perf_counter() - expected)
+
+
+async def serve_fake_llm(**kwargs) -> tuple:
+    """
+    在临时端口上启动模拟服务，返回(server, task, 端口)
+    """
+    server = uvicorn.Server(uvicorn.Config(create_app(**kwargs), host="127.0.0.1", port=0, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, task, port
+
+
+@pytest.fixture
+def llm_globals(monkeypatch):
+    monkeypatch.setattr(app3d, "logger", logging.getLogger("llm"), raising=False)
+    monkeypatch.setattr(app3d, "model_name", "fake", raising=False)
+    monkeypatch.setattr(app3d, "llm_cache_hints", {}, raising=False)
+    monkeypatch.setattr(app3d, "metrics", app3d.Metrics(), raising=False)
+
+    def use_port(port: int):
+        client = openai.AsyncOpenAI(api_key="aaa", base_url=f"http://127.0.0.1:{port}/v1")
+        monkeypatch.setattr(app3d, "openai_client", client, raising=False)
+    return use_port
+
+
+async def stream_with_heartbeat(use_port) -> tuple:
+    server, task, port = await serve_fake_llm(token_rate=50.0, first_token_delay=0.2)
+    use_port(port)
+    lags, stop, tokens, usage = [], asyncio.Event(), [], []
+    beat = asyncio.create_task(heartbeat(lags, stop))
+    try:
+        async for token, _ in app3d.stream_llm_tokens([{"role": "user", "content": "你好"}], on_usage=usage.append):
+            tokens.append(token)
+    finally:
+        stop.set()
+        await beat
+        server.should_exit = True
+        await task
+    return "".join(tokens), lags, usage
+
+
+def test_streaming_does_not_block_event_loop(llm_globals):
+    reply, lags, _ = asyncio.run(stream_with_heartbeat(llm_globals))
+    assert reply == DEFAULT_REPLY
+    # 整段回复约2秒，心跳应一直在跳
+    assert len(lags) > 50
+    assert max(lags) < MAX_LAG
+
+
+def test_streaming_reports_prompt_usage(llm_globals):
+    _, _, usage = asyncio.run(stream_with_heartbeat(llm_globals))
+    assert usage == [len("你好") + 4]
@@ -0,0 +1,140 @@
+# test_segmenter.py
+# 流式分句、思考标签拆分和思考内容过滤的单元测试
+
+import os
+import sys
+from collections import deque
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app3d  # noqa: E402
+from app3d import ReasoningFilter, SentenceSegmenter, ThinkTagSplitter  # noqa: E402
+
+
+def feed_all(segmenter: SentenceSegmenter, tokens: list) -> list:
+    sentences = []
+    for token in tokens:
+        sentences.extend(segmenter.feed(token))
+    return sentences
+
+
+def test_first_sentence_splits_at_any_punctuation_after_first_min_chars():
+    segmenter = SentenceSegmenter(first_min_chars=4, min_chars=10, max_chars=30)
+    assert feed_all(segmenter, ["欢迎", "欢迎", "，我", "是丧彪"]) == ["欢迎欢迎，"]
+
+
+def test_first_sentence_waits_until_first_min_chars():
+    segmenter = SentenceSegmenter(first_min_chars=4)
+    assert segmenter.feed("好，") == []
+    assert segmenter.feed("那我来，") == ["好，那我来，"]
+
+
+def test_later_sentences_need_strong_punctuation_and_min_chars():
+    segmenter = SentenceSegmenter(first_min_chars=2, min_chars=10, max_chars=30)
+    assert segmenter.feed("你好，") == ["你好，"]
+    # 逗号不够切分条件，句号但不足min_chars也不切
+    assert segmenter.feed("今天，天气好。") == []
+    assert segmenter.feed("我们出去玩吧。") == ["今天，天气好。我们出去玩吧。"]
+
+
+def test_max_chars_splits_at_weak_punctuation():
+    segmenter = SentenceSegmenter(first_min_chars=2, min_chars=10, max_chars=12)
+    segmenter.feed("嗯，")
+    assert segmenter.feed("这是一个没有句号的很长的句子，") == ["这是一个没有句号的很长的句子，"]
+
+
+def test_no_split_without_punctuation():
+    segmenter = SentenceSegmenter(first_min_chars=2, max_chars=5)
+    assert feed_all(segmenter, ["一二三", "四五六", "七八九"]) == []
+    assert segmenter.flush() == ["一二三四五六七八九"]
+
+
+def test_flush_returns_remainder_and_resets_first_sentence_policy():
+    segmenter = SentenceSegmenter(first_min_chars=2, min_chars=10)
+    assert segmenter.feed("你好，今天") == ["你好，"]
+    assert segmenter.flush() == ["今天"]
+    assert segmenter.flush() == []
+    # flush后重新按首句规则切分
+    assert segmenter.feed("再见，") == ["再见，"]
+
+
+def test_flush_skips_whitespace_only():
+    segmenter = SentenceSegmenter()
+    segmenter.feed("  \n")
+    assert segmenter.flush() == []
+
+
+def test_closing_quotes_stay_with_sentence():
+    segmenter = SentenceSegmenter(first_min_chars=2)
+    assert segmenter.feed("他说：“好的！”然后") == ["他说：“好的！”"]
+
+
+def split_all(tokens: list) -> list:
+    splitter = ThinkTagSplitter()
+    parts = []
+    for token in tokens:
+        parts.extend(splitter.feed(token))
+    parts.extend(splitter.flush())
+    think = "".join(text for is_think, text in parts if is_think)
+    answer = "".join(text for is_think, text in parts if not is_think)
+    return think, answer
+
+
+@pytest.mark.parametrize("tokens", [
+    ["<think>", "想一想", "</think>", "你好"],
+    ["<th", "ink>想一", "想</thi", "nk>你好"],
+    ["<", "t", "h", "i", "n", "k", ">", "想一想", "<", "/", "think", ">", "你好"],
+    ["<think>想一想</think>你好"],
+    ["<think>想一想</", "think>你", "好"],
+])
+def test_think_tags_split_across_tokens(tokens):
+    assert split_all(tokens) == ("想一想", "你好")
+
+
+def test_partial_tag_that_is_not_a_tag_is_answer():
+    assert split_all(["1 <", " 2，a<b"]) == ("", "1 < 2，a<b")
+
+
+def test_unclosed_partial_tag_is_flushed():
+    assert split_all(["你好<thi"]) == ("", "你好<thi")
+
+
+def test_answer_tokens_without_tags_pass_through():
+    splitter = ThinkTagSplitter()
+    assert splitter.feed("你好") == [(False, "你好")]
+    assert splitter.feed("") == []
+
+
+@pytest.fixture
+def reasoning_log(monkeypatch):
+    log = deque(maxlen=8)
+    monkeypatch.setattr(app3d, "reasoning_log", log, raising=False)
+    return log
+
+
+def run_filter(tokens: list, log_chars: int = 0) -> tuple:
+    reasoning = ReasoningFilter(log_chars=log_chars)
+    answer = "".join(reasoning.feed(token) for token in tokens) + reasoning.finish()
+    return reasoning, answer
+
+
+def test_reasoning_filter_drops_think_and_counts_it(reasoning_log):
+    reasoning, answer = run_filter(["<thi", "nk>嗯，观众", "在问</th", "ink>\n今天吃火锅！"])
+    assert answer == "\n今天吃火锅！"
+    assert reasoning.reasoning_chars == len("嗯，观众在问")
+    assert len(reasoning_log) == 0
+
+
+def test_reasoning_filter_keeps_truncated_reasoning_when_enabled(reasoning_log):
+    run_filter(["<think>", "一二三四五", "六七", "</think>", "好"], log_chars=6)
+    assert list(reasoning_log) == ["一二三四五六"]
+
+
+def test_reasoning_filter_without_think_is_identity(reasoning_log):
+    tokens = ["大家", "好，", "a < b", "。"]
+    reasoning, answer = run_filter(tokens, log_chars=100)
+    assert answer == "".join(tokens)
+    assert reasoning.reasoning_chars == 0
+    assert len(reasoning_log) == 0